@@ -19,6 +19,10 @@ import sys
 import wx, wx.grid
 from PIL import Image
 
+from capture import RingCapture
+from chessboard import CORNER_CACHE_FILE, ChessboardTracker, CornerCache, CoverageIndex
+from solver import CalibrationSolver, solveMono
+
 scriptPath = os.path.dirname(os.path.abspath(__file__))
 logger = logging.getLogger('stereo_wx')
 
@@ -239,6 +243,28 @@ class Calibrate(wx.Frame):
         self.takeCalibrationPicture = True
         logger.debug("Take calibration pic")
 
+    def onAutoCapture(self, evt):
+        # The index is made on the video thread, which knows the frame size
+        self.coverageIndex = None
+        self.autoCapture = self.autoCaptureItem.IsChecked()
+
+    def autoCapturePicture(self, corners, imageSize):
+        """Whether to take the board as a calibration picture, on the video thread."""
+        # Read once, the menu can reset it meanwhile
+        coverageIndex = self.coverageIndex
+        if coverageIndex is None or coverageIndex.imageSize != imageSize or \
+                coverageIndex.checkerboard != self.CHECKERBOARD:
+            coverageIndex = self.coverageIndex = CoverageIndex(imageSize, self.CHECKERBOARD)
+        if not coverageIndex.offer(corners):
+            return False
+
+        logger.info(f"Auto capture, {coverageIndex.report()}")
+        if coverageIndex.complete():
+            self.autoCapture = False
+            wx.CallAfter(self.autoCaptureItem.Check, False)
+            logger.info("Auto capture done, the pictures cover the target")
+        return True
+
     def onCalibrationCalc(self, evt):
         logger.debug("Calc calibration")
         self.calibrationCalc()
@@ -291,13 +317,25 @@ class Calibrate(wx.Frame):
         self.leftWxImageForDisplay = None
         self.leftWxOutputForDisplay = None
         self.takeCalibrationPicture = False
+        # Takes pictures of board poses not covered yet
+        self.autoCapture = False
+        self.coverageIndex = None
         self.readSavedPictures = False
         self.imageSavepath = tempfile.mkdtemp()
         self.savedImageNumber = 0
         self.objpoints = []
         self.imgpointsLeft = []
+        self.imageSize = None
         self.stereo = cv2.StereoBM_create()
         self.newCameraMatrixLeft = None
+        # Solves in a worker process, the dialog shows its progress
+        self.calibrationSolver = CalibrationSolver()
+        self.calibrationDialog = None
+        # From starting a solve until its result or failure is handled here, the
+        # worker process ends before that
+        self.calibrationBusy = False
+        self.calibrationTimer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.onCalibrationTimer, self.calibrationTimer)
         self.chessboardDistancePhysicalWidth = 0.0335;
         self.chessboardDistance = 2.010;
 
@@ -333,6 +371,10 @@ class Calibrate(wx.Frame):
         loadCoefficientsItem = fileMenu.Append(wx.ID_ANY, 'Load calibration...')
         self.Bind(wx.EVT_MENU, self.loadCoefficients, loadCoefficientsItem)
 
+        self.autoCaptureItem = fileMenu.AppendCheckItem(wx.ID_ANY, 'Auto capture calibration pics',
+                                                        'Take pictures of new board poses until they cover enough')
+        self.Bind(wx.EVT_MENU, self.onAutoCapture, self.autoCaptureItem)
+
         fileItem = fileMenu.Append(wx.ID_EXIT, 'Quit', 'Quit application')
         self.Bind(wx.EVT_MENU, self.Close, fileItem)
         menubar.Append(fileMenu, '&File')
@@ -410,6 +452,10 @@ class Calibrate(wx.Frame):
         self.paused = False
         leftImage = None
         storedPic = False
+        storedCorners = None
+        cornerCache = None
+        # Live frames search a downscaled frame, near the last board once found
+        leftTracker = ChessboardTracker()
         leftOK = False
         self.savedImageNumber = 0
         self.cameraMatrixLeft = None
@@ -426,20 +472,24 @@ class Calibrate(wx.Frame):
             self.capLeft.release()
 
         if self.leftDevice is not None:
-            self.capLeft = cv2.VideoCapture(self.leftDevice)
-            self.capLeft.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-            self.capLeft.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
+            self.capLeft = RingCapture(self.leftDevice, width=640, height=480)
 
         while not self.stopVideo:
             if self.readSavedPictures:
                 leftImageFile = os.path.join(self.imageSavepath, "image_" + str(self.savedImageNumber) + ".jpg")
 
                 if os.path.exists(leftImageFile):
-                    leftImage = cv2.imread(leftImageFile)
+                    # Corners of saved pictures are cached, reloading the same set skips the detection
+                    if cornerCache is None:
+                        cornerCache = CornerCache(os.path.join(self.imageSavepath, CORNER_CACHE_FILE))
+                    leftImage, storedCorners = cornerCache.load(leftImageFile, self.CHECKERBOARD)
                     storedPic = True
                     self.savedImageNumber = self.savedImageNumber + 1
                 else:
                     self.readSavedPictures = False
+                    if cornerCache is not None:
+                        cornerCache.close()
+                        cornerCache = None
                     leftImage = None
                     continue
             else:
@@ -453,12 +503,11 @@ class Calibrate(wx.Frame):
 
             self.grayLeft = cv2.cvtColor(leftImage, cv2.COLOR_BGR2GRAY)
 
-            leftRet, cornersLeft = cv2.findChessboardCorners(self.grayLeft, self.CHECKERBOARD,
-                                cv2.CALIB_CB_ADAPTIVE_THRESH + cv2.CALIB_CB_FAST_CHECK + cv2.CALIB_CB_NORMALIZE_IMAGE)
+            # Refined to subpixel at full resolution, None without a chessboard
+            cornersLeft2 = storedCorners if storedPic else leftTracker.find(self.grayLeft, self.CHECKERBOARD)
 
-            if leftRet:
-                cornersLeft2 = cv2.cornerSubPix(self.grayLeft, cornersLeft, (11, 11), (-1, -1), self.criteria)
-                displayLeft = cv2.drawChessboardCorners(leftImage.copy(), self.CHECKERBOARD, cornersLeft2, leftRet)
+            if cornersLeft2 is not None:
+                displayLeft = cv2.drawChessboardCorners(leftImage.copy(), self.CHECKERBOARD, cornersLeft2, True)
                 self.displayInputImage(displayLeft)
 
                 sortedByX = sorted(cornersLeft2[:,0], key=lambda x: x[0]);
@@ -469,6 +518,9 @@ class Calibrate(wx.Frame):
 
                 self.focalLength = (innerWidth * self.chessboardDistance) / self.chessboardDistancePhysicalWidth
 
+                if self.autoCapture and not storedPic and self.autoCapturePicture(cornersLeft2, self.grayLeft.shape[::-1]):
+                    self.takeCalibrationPicture = True
+
                 if (self.takeCalibrationPicture or storedPic) and  len(cornersLeft2):
                     self.takeCalibrationPicture = False
 
@@ -476,7 +528,9 @@ class Calibrate(wx.Frame):
                         cv2.imwrite(os.path.join(self.imageSavepath, "image_" + str(self.savedImageNumber) + ".jpg"), leftImage)
                         self.savedImageNumber = self.savedImageNumber + 1;
 
-                    self.imgpointsLeft.append(cornersLeft)
+                    self.imageSize = self.grayLeft.shape[::-1]
+                    self.imgpointsLeft.append(cornersLeft2)
+                    # Last, a calibration snapshot takes as many points as there are objpoints
                     self.objpoints.append(self.objp)
 
                 else:
@@ -491,14 +545,50 @@ class Calibrate(wx.Frame):
         if not self.savedImageNumber:
             logger.debug("No images for calibration")
             return
+        if self.calibrationBusy:
+            logger.info("Calibration already running")
+            return
 
-        retvalLeft, self.cameraMatrixLeft, self.distCoeffsLeft, self.rvecsLeft, self.tvecsLeft  = cv2.calibrateCamera(
-                                                                    self.objpoints,
-                                                                    self.imgpointsLeft,
-                                                                    self.grayLeft.shape[::-1],
-                                                                    None, None)
-        hL, wL = self.grayLeft.shape[:2]
-        self.newCameraMatrixLeft, self.roiLeft  = cv2.getOptimalNewCameraMatrix(self.cameraMatrixLeft, self.distCoeffsLeft, (wL,hL),1,(wL,hL))
+        # Snapshot of the points, the video thread keeps adding to the lists
+        count = len(self.objpoints)
+        points = (self.objpoints[:count], self.imgpointsLeft[:count], self.imageSize)
+
+        self.calibrationDialog = wx.ProgressDialog("Calibration", f"Calibrating with {count} pictures", maximum=100,
+                                                   parent=self, style=wx.PD_CAN_ABORT | wx.PD_ELAPSED_TIME)
+        self.calibrationTimer.Start(200)
+        self.calibrationSolver.start(solveMono, points,
+                                     lambda *progress: wx.CallAfter(self.onCalibrationProgress, *progress),
+                                     lambda result: wx.CallAfter(self.applyCalibration, result),
+                                     lambda message: wx.CallAfter(self.onCalibrationFailed, message))
+        self.calibrationBusy = True
+
+    def onCalibrationProgress(self, step, steps, message):
+        if self.calibrationDialog is not None:
+            self.calibrationDialog.Update(100 * step // steps, message)
+
+    def onCalibrationTimer(self, evt):
+        # The cancel button is only noticed by polling
+        if self.calibrationDialog is not None and self.calibrationDialog.WasCancelled():
+            self.calibrationSolver.cancel()
+
+    def closeCalibrationDialog(self):
+        self.calibrationTimer.Stop()
+        if self.calibrationDialog is not None:
+            self.calibrationDialog.Destroy()
+            self.calibrationDialog = None
+
+    def onCalibrationFailed(self, message):
+        self.calibrationBusy = False
+        self.closeCalibrationDialog()
+        logger.info(f"Calibration failed: {message}")
+
+    def applyCalibration(self, result):
+        self.calibrationBusy = False
+        self.closeCalibrationDialog()
+        # The result keys are the attribute names
+        for name, value in result.items():
+            setattr(self, name, value)
+        logger.info("Calibration done")
 
 
 # ------------------------------------------------------------------------------------------
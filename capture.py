@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#cython: language_level=3, boundscheck=False
+###############################################################################
+#
+# Video capture shared by the calibration and stereo scripts.
+#
+# Frames are read into a small ring of preallocated buffers instead of a
+# new numpy array per frame, which keeps the allocator and GC quiet during
+# long sessions with two cameras.
+#
+###############################################################################
+import collections
+import threading
+import time
+
+import cv2
+import numpy as np
+
+#---------------------------------------------------------------------
+
+class FrameRing:
+    """Preallocated frame buffers, borrowed and returned by slot number."""
+
+    def __init__(self, slots):
+        self.buffers = [None] * slots
+        self.free = list(range(slots))
+        self.condition = threading.Condition()
+
+    def acquire(self, timeout=None):
+        """Borrow a free slot, waiting for one to be returned if needed. None on timeout."""
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.free, timeout):
+                return None
+            return self.free.pop(0)
+
+    def release(self, slot):
+        with self.condition:
+            self.free.append(slot)
+            self.condition.notify()
+
+    def allocate(self, frame):
+        # Sized from the first frame, since the device decides the real resolution
+        for slot in range(len(self.buffers)):
+            if self.buffers[slot] is None or self.buffers[slot].shape != frame.shape:
+                self.buffers[slot] = np.empty_like(frame)
+
+#---------------------------------------------------------------------
+
+class RingCapture:
+    """cv2.VideoCapture reading into a FrameRing.
+
+    borrow() / giveBack() hand out slots explicitly. read() is a drop-in for
+    VideoCapture.read(): it gives back the frame from the previous read(), so
+    that frame is only valid until the next call."""
+
+    def __init__(self, device, slots=3, width=None, height=None):
+        self.cap = cv2.VideoCapture(device)
+        if width is not None:
+            self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        if height is not None:
+            self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+
+        self.ring = FrameRing(slots)
+        self.lastSlot = None
+
+    def grab(self):
+        return self.cap.grab()
+
+    def borrow(self, timeout=None, grabbed=False):
+        """Read the next frame into a free slot. Returns (slot, frame), or (None, None)
+        when there is no frame or no free slot. With grabbed, the frame from the last
+        grab() is retrieved instead of reading a new one."""
+        slot = self.ring.acquire(timeout)
+        if slot is None:
+            return None, None
+
+        frame = self.fill(slot, grabbed)
+        if frame is None:
+            return None, None
+        return slot, frame
+
+    def fill(self, slot, grabbed=False):
+        """Read into an already borrowed slot. On failure the slot is given back and None returned."""
+        buffer = self.ring.buffers[slot]
+        if grabbed:
+            ok, frame = self.cap.retrieve(image=buffer)
+        else:
+            ok, frame = self.cap.read(image=buffer)
+
+        if not ok or frame is None:
+            self.ring.release(slot)
+            return None
+
+        if frame is not buffer:
+            # First frame, or the resolution changed
+            self.ring.allocate(frame)
+            self.ring.buffers[slot] = frame
+
+        return frame
+
+    def giveBack(self, slot):
+        self.ring.release(slot)
+
+    def read(self):
+        if self.lastSlot is not None:
+            self.giveBack(self.lastSlot)
+            self.lastSlot = None
+
+        self.lastSlot, frame = self.borrow()
+        return frame is not None, frame
+
+    #---------------------------------------------------------------------
+
+    def isOpened(self):
+        return self.cap.isOpened()
+
+    def get(self, propId):
+        return self.cap.get(propId)
+
+    def set(self, propId, value):
+        return self.cap.set(propId, value)
+
+    def release(self):
+        self.cap.release()
+
+#---------------------------------------------------------------------
+
+TimedFrame = collections.namedtuple('TimedFrame', ['slot', 'frame', 'timestamp', 'sequence'])
+
+
+class CameraReader(threading.Thread):
+    """Grabs frames from one camera on its own thread, stamping each with the
+    monotonic time the grab returned."""
+
+    def __init__(self, device, condition, barrier=None, width=None, height=None, slots=4, latestOnly=False):
+        threading.Thread.__init__(self, daemon=True, name=f"camera {device}")
+        self.capture = RingCapture(device, slots, width, height)
+        self.condition = condition
+        self.barrier = barrier
+        self.latestOnly = latestOnly
+        self.frames = collections.deque()
+        self.sequence = 0
+        self.dropped = 0
+        self.running = True
+        self.ended = False
+
+    def run(self):
+        try:
+            while self.running:
+                if self.barrier is not None:
+                    # Line up the grabs of both cameras
+                    self.barrier.wait()
+
+                if not self.capture.grab():
+                    break
+                timestamp = time.monotonic()
+                self.sequence += 1
+
+                slot = None
+                if self.latestOnly:
+                    # Never wait for the consumer: reuse the oldest unread frame instead
+                    slot = self.capture.ring.acquire(timeout=0)
+                    if slot is None:
+                        with self.condition:
+                            if self.frames:
+                                slot = self.frames.popleft().slot
+                                self.dropped += 1
+
+                # Wait for the consumer to give a slot back
+                while slot is None and self.running:
+                    slot = self.capture.ring.acquire(timeout=0.1)
+
+                if slot is None:
+                    break
+
+                frame = self.capture.fill(slot, grabbed=True)
+                if frame is None:
+                    break
+
+                with self.condition:
+                    self.frames.append(TimedFrame(slot, frame, timestamp, self.sequence))
+                    self.condition.notify_all()
+        except threading.BrokenBarrierError:
+            pass
+        finally:
+            if self.barrier is not None:
+                self.barrier.abort()
+            with self.condition:
+                self.ended = True
+                self.condition.notify_all()
+
+    def stop(self):
+        self.running = False
+        if self.barrier is not None:
+            self.barrier.abort()
+
+
+class StereoCapture:
+    """Two cameras read on their own threads, paired by nearest timestamp.
+
+    In lockstep mode both threads meet before every grab(), so the two grabs
+    happen together and each frame is then retrieve()d on its own thread;
+    frames from the same round are paired. Otherwise frames whose timestamps
+    are further apart than tolerance (seconds) are not paired, and the older
+    one is dropped.
+
+    With latestOnly the cameras are drained continuously whatever the consumer
+    does, and readPair() returns the newest matching pair, dropping anything
+    older. The view then lags the cameras by at most one processing cycle."""
+
+    def __init__(self, leftDevice, rightDevice, width=None, height=None, tolerance=0.015, slots=4, lockstep=True,
+                 latestOnly=False):
+        self.tolerance = tolerance
+        self.lockstep = lockstep
+        self.latestOnly = latestOnly
+        self.condition = threading.Condition()
+        barrier = threading.Barrier(2) if lockstep else None
+
+        self.left = CameraReader(leftDevice, self.condition, barrier, width, height, slots, latestOnly)
+        self.right = CameraReader(rightDevice, self.condition, barrier, width, height, slots, latestOnly)
+        self.lastPair = None
+
+        self.pairs = 0
+        self.droppedLeft = 0
+        self.droppedRight = 0
+        self.lastSkew = 0.0
+        self.totalSkew = 0.0
+        self.maxSkew = 0.0
+
+        self.left.start()
+        self.right.start()
+
+    #---------------------------------------------------------------------
+
+    def distance(self, left, right):
+        # Signed, negative when the left frame is older
+        if self.lockstep:
+            return left.sequence - right.sequence
+        return left.timestamp - right.timestamp
+
+    def matches(self, distance):
+        return distance == 0 if self.lockstep else abs(distance) <= self.tolerance
+
+    def dropUntil(self, reader, index):
+        for _ in range(index):
+            reader.capture.giveBack(reader.frames.popleft().slot)
+        return index
+
+    def matchLatest(self):
+        # Called with the condition held. The queues are only a few frames long.
+        best = None
+        for i, left in enumerate(self.left.frames):
+            distances = [abs(self.distance(left, right)) for right in self.right.frames]
+            if distances and self.matches(min(distances)):
+                best = (i, distances.index(min(distances)))
+
+        if best is None:
+            return None
+
+        self.droppedLeft += self.dropUntil(self.left, best[0])
+        self.droppedRight += self.dropUntil(self.right, best[1])
+        return self.matchPair()
+
+    def matchPair(self):
+        # Called with the condition held
+        while self.left.frames and self.right.frames:
+            left = self.left.frames[0]
+            right = self.right.frames[0]
+            distance = self.distance(left, right)
+
+            if self.matches(distance):
+                skew = left.timestamp - right.timestamp
+                self.left.frames.popleft()
+                self.right.frames.popleft()
+                self.pairs += 1
+                self.lastSkew = skew
+                self.totalSkew += abs(skew)
+                self.maxSkew = max(self.maxSkew, abs(skew))
+                return left, right
+
+            # The older frame can only get further from anything that comes later
+            if distance < 0:
+                self.left.capture.giveBack(self.left.frames.popleft().slot)
+                self.droppedLeft += 1
+            else:
+                self.right.capture.giveBack(self.right.frames.popleft().slot)
+                self.droppedRight += 1
+        return None
+
+    def readPair(self, timeout=5.0):
+        """Next matched (left, right) pair of TimedFrames, or None when a camera has
+        stopped or nothing matched within the timeout. Give it back with giveBack()."""
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                pair = self.matchLatest() if self.latestOnly else self.matchPair()
+                if pair is not None:
+                    return pair
+
+                if (self.left.ended and not self.left.frames) or (self.right.ended and not self.right.frames):
+                    return None
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+    def giveBack(self, pair):
+        left, right = pair
+        self.left.capture.giveBack(left.slot)
+        self.right.capture.giveBack(right.slot)
+
+    def read(self):
+        """Drop-in for reading both cameras: (ok, leftImage, rightImage). The images
+        are only valid until the next call."""
+        if self.lastPair is not None:
+            self.giveBack(self.lastPair)
+            self.lastPair = None
+
+        self.lastPair = self.readPair()
+        if self.lastPair is None:
+            return False, None, None
+        return True, self.lastPair[0].frame, self.lastPair[1].frame
+
+    #---------------------------------------------------------------------
+
+    def dropped(self):
+        """Frames of each camera that were never handed out, (left, right)."""
+        return self.droppedLeft + self.left.dropped, self.droppedRight + self.right.dropped
+
+    def report(self):
+        meanSkew = self.totalSkew / self.pairs if self.pairs else 0.0
+        droppedLeft, droppedRight = self.dropped()
+        return (f"{self.pairs} pairs, skew last {self.lastSkew * 1000:.1f} ms mean {meanSkew * 1000:.1f} ms "
+                f"max {self.maxSkew * 1000:.1f} ms, dropped left {droppedLeft} right {droppedRight}")
+
+    def isOpened(self):
+        return self.left.capture.isOpened() and self.right.capture.isOpened()
+
+    def release(self):
+        self.left.stop()
+        self.right.stop()
+        self.left.join(1)
+        self.right.join(1)
+        self.left.capture.release()
+        self.right.capture.release()
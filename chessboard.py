@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#cython: language_level=3, boundscheck=False
+###############################################################################
+#
+# Chessboard corner detection for calibration, with offline detection of a
+# whole folder of stereo pairs spread over a process pool.
+#
+# Corners found in saved images are cached next to them, so reloading an
+# image set (say to try other calibration flags) skips the detection.
+#
+# Live frames go through a ChessboardTracker, which searches a downscaled
+# frame and only refines the corners at full resolution.
+#
+###############################################################################
+import collections
+import concurrent.futures
+import hashlib
+import itertools
+import sqlite3
+
+import cv2
+import numpy as np
+
+CHESSBOARD_FLAGS = cv2.CALIB_CB_ADAPTIVE_THRESH + cv2.CALIB_CB_FAST_CHECK + cv2.CALIB_CB_NORMALIZE_IMAGE
+SUBPIX_WINDOW = (11, 11)
+SUBPIX_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+
+# Sidecar file in the folder of the images
+CORNER_CACHE_FILE = "corners.sqlite"
+
+#---------------------------------------------------------------------
+
+def findCorners(gray, checkerboard):
+    """Chessboard corners refined to subpixel, or None when there is no chessboard."""
+    found, corners = cv2.findChessboardCorners(gray, checkerboard, CHESSBOARD_FLAGS)
+    if not found:
+        return None
+    return cv2.cornerSubPix(gray, corners, SUBPIX_WINDOW, (-1, -1), SUBPIX_CRITERIA)
+
+
+class ChessboardTracker:
+    """Chessboard search for live frames, one tracker per camera.
+
+    The search runs on the frame shrunk by searchScale, kept between
+    minSearchWidth and maxSearchWidth pixels wide (so a 640x480 camera is
+    searched at 320 wide, a 1920 wide one at 640). The corners found there are
+    scaled back and refined with cornerSubPix on the full resolution frame. Once a board is found, the next frames only search
+    the region around it (grown by margin, a fraction of its size), and the
+    whole frame again after a miss there."""
+
+    def __init__(self, searchScale=0.5, minSearchWidth=320, maxSearchWidth=640, margin=0.25):
+        self.searchScale = searchScale
+        self.minSearchWidth = minSearchWidth
+        self.maxSearchWidth = maxSearchWidth
+        self.margin = margin
+        # (x, y, width, height) of the last board, in full resolution pixels
+        self.roi = None
+
+    def region(self, shape):
+        height, width = shape
+        if self.roi is None:
+            return 0, 0, width, height
+        x, y, roiWidth, roiHeight = self.roi
+        marginX = int(roiWidth * self.margin) + SUBPIX_WINDOW[0]
+        marginY = int(roiHeight * self.margin) + SUBPIX_WINDOW[1]
+        x0, y0 = max(x - marginX, 0), max(y - marginY, 0)
+        x1, y1 = min(x + roiWidth + marginX, width), min(y + roiHeight + marginY, height)
+        return x0, y0, x1 - x0, y1 - y0
+
+    def scale(self, frameWidth):
+        """Scale of the search image for frames this wide, 1.0 for no downscaling."""
+        searchWidth = min(max(frameWidth * self.searchScale, self.minSearchWidth), self.maxSearchWidth)
+        return min(1.0, searchWidth / frameWidth)
+
+    def search(self, gray, checkerboard, region):
+        # The same scale for the whole frame and a region of it
+        scale = self.scale(gray.shape[1])
+        x, y, width, height = region
+        crop = gray[y:y + height, x:x + width]
+        if scale < 1.0:
+            crop = cv2.resize(crop, (max(int(width * scale), 1), max(int(height * scale), 1)),
+                              interpolation=cv2.INTER_AREA)
+
+        found, corners = cv2.findChessboardCorners(crop, checkerboard, CHESSBOARD_FLAGS)
+        if not found:
+            return None
+        # Pixel centers of the small image back to the frame
+        corners = (corners + 0.5) / scale - 0.5
+        corners += np.array([x, y], np.float32)
+        return corners
+
+    def find(self, gray, checkerboard):
+        """Chessboard corners refined to subpixel at full resolution, or None."""
+        corners = None
+        if self.roi is not None:
+            corners = self.search(gray, checkerboard, self.region(gray.shape))
+        if corners is None:
+            corners = self.search(gray, checkerboard, (0, 0, gray.shape[1], gray.shape[0]))
+        if corners is None:
+            self.roi = None
+            return None
+
+        corners = cv2.cornerSubPix(gray, corners, SUBPIX_WINDOW, (-1, -1), SUBPIX_CRITERIA)
+        self.roi = cv2.boundingRect(corners)
+        return corners
+
+#---------------------------------------------------------------------
+
+class CoverageIndex:
+    """Board poses seen so far, to capture calibration pictures automatically.
+
+    A board falls into bins of three kinds: the cells of an image grid its
+    corners are in, a tilt bin (foreshortening left/right and up/down, from
+    the lengths of opposite board edges) and a scale bin (board size relative
+    to the image). offer() accepts a board that is held still, falls into a
+    bin with fewer than perBin views and is not a near duplicate: its corners
+    must be on average more than minDistance pixels from those of every view
+    accepted before. coverage() is the filled share of all bins, complete()
+    says when it reached target."""
+
+    def __init__(self, imageSize, checkerboard, gridSize=(4, 3), tiltThreshold=0.1, scaleEdges=(0.3, 0.5),
+                 perBin=2, target=0.9, maxMotion=2.0, minDistance=20.0):
+        self.imageSize = imageSize
+        self.checkerboard = checkerboard
+        self.gridSize = gridSize
+        # |log| of the ratio of opposite edges above which a board counts as tilted
+        self.tiltThreshold = tiltThreshold
+        self.scaleEdges = scaleEdges
+        self.perBin = perBin
+        self.target = target
+        # Mean corner motion in pixels since the last frame, more is likely blurred
+        self.maxMotion = maxMotion
+        self.minDistance = minDistance
+
+        self.cellCounts = np.zeros(gridSize[::-1], np.int32)
+        self.tiltCounts = np.zeros((3, 3), np.int32)
+        self.scaleCounts = np.zeros(len(scaleEdges) + 1, np.int32)
+        self.lastCorners = None
+        # Corners of the accepted views, V x N x 2
+        self.acceptedCorners = np.empty((0, checkerboard[0] * checkerboard[1], 2), np.float32)
+        self.accepted = 0
+
+    def cells(self, points):
+        columns = np.clip((points[:, 0] * self.gridSize[0] / self.imageSize[0]).astype(int), 0, self.gridSize[0] - 1)
+        rows = np.clip((points[:, 1] * self.gridSize[1] / self.imageSize[1]).astype(int), 0, self.gridSize[1] - 1)
+        return np.unique(rows), np.unique(columns), (rows, columns)
+
+    def tiltBin(self, points):
+        # Outer corners of the board, then the pair of opposite edges that are apart
+        # along x and the pair apart along y, whatever way round the board was found
+        grid = points.reshape(self.checkerboard[1], self.checkerboard[0], 2)
+        first, last = (grid[0, 0], grid[0, -1]), (grid[-1, 0], grid[-1, -1])
+        edges = [(first[0], last[0]), (first[1], last[1]), (first[0], first[1]), (last[0], last[1])]
+        pairs = (edges[0:2], edges[2:4])
+
+        def split(pair, axis):
+            (a, b), (c, d) = pair
+            lengths = np.linalg.norm(b - a), np.linalg.norm(d - c)
+            # Positive when the edge further along the axis is the longer one
+            if (a[axis] + b[axis]) > (c[axis] + d[axis]):
+                lengths = lengths[::-1]
+            return np.log(max(lengths[1], 1e-6) / max(lengths[0], 1e-6)), abs((a + b - c - d)[axis])
+
+        horizontal = max(pairs, key=lambda pair: split(pair, 0)[1])
+        vertical = pairs[1] if horizontal is pairs[0] else pairs[0]
+
+        def bucket(ratio):
+            return 0 if ratio < -self.tiltThreshold else 2 if ratio > self.tiltThreshold else 1
+
+        return bucket(split(horizontal, 0)[0]), bucket(split(vertical, 1)[0])
+
+    def scaleBin(self, points):
+        area = cv2.contourArea(cv2.convexHull(points.astype(np.float32)))
+        scale = np.sqrt(area / (self.imageSize[0] * self.imageSize[1]))
+        return int(np.searchsorted(self.scaleEdges, scale))
+
+    def nearDuplicate(self, points):
+        """Whether the board is within minDistance of an accepted view, the corners in
+        either order (a board turned half way round is found back to front)."""
+        if not len(self.acceptedCorners):
+            return False
+        distances = [np.linalg.norm(self.acceptedCorners - ordered, axis=2).mean(axis=1)
+                     for ordered in (points, points[::-1])]
+        return np.minimum(*distances).min() <= self.minDistance
+
+    def offer(self, corners):
+        """Add the board if it is still and fills an under-covered bin. Returns whether it was added."""
+        points = corners.reshape(-1, 2)
+        lastCorners, self.lastCorners = self.lastCorners, points.copy()
+        if lastCorners is None or lastCorners.shape != points.shape:
+            return False
+        if np.linalg.norm(points - lastCorners, axis=1).mean() > self.maxMotion:
+            return False
+        if self.nearDuplicate(points):
+            return False
+
+        _, _, (rows, columns) = self.cells(points)
+        cells = np.unique(rows * self.gridSize[0] + columns)
+        cellCounts = self.cellCounts.reshape(-1)
+        tilt = self.tiltBin(points)
+        scale = self.scaleBin(points)
+        if (cellCounts[cells] >= self.perBin).all() and self.tiltCounts[tilt] >= self.perBin and \
+                self.scaleCounts[scale] >= self.perBin:
+            return False
+
+        cellCounts[cells] += 1
+        self.tiltCounts[tilt] += 1
+        self.scaleCounts[scale] += 1
+        self.acceptedCorners = np.concatenate([self.acceptedCorners, points[None].astype(np.float32)])
+        self.accepted += 1
+        return True
+
+    def coverage(self):
+        counts = np.concatenate([self.cellCounts.reshape(-1), self.tiltCounts.reshape(-1), self.scaleCounts])
+        return np.minimum(counts, self.perBin).sum() / (len(counts) * self.perBin)
+
+    def complete(self):
+        return self.coverage() >= self.target
+
+    def report(self):
+        filled = lambda counts: f"{(counts >= self.perBin).sum()}/{counts.size}"
+        return (f"{self.accepted} pictures, coverage {self.coverage() * 100:.0f}% (cells {filled(self.cellCounts)}, "
+                f"tilts {filled(self.tiltCounts)}, scales {filled(self.scaleCounts)})")
+
+#---------------------------------------------------------------------
+
+def fileDigest(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+class CornerCache:
+    """Detected corners of image files, kept in an SQLite file next to the images.
+
+    Entries are keyed by the SHA-1 of the file contents, the board size and the
+    detection settings, so a changed image or another board is detected again.
+    Images without a chessboard are remembered as well."""
+
+    SETTINGS = repr((CHESSBOARD_FLAGS, SUBPIX_WINDOW, SUBPIX_CRITERIA))
+
+    def __init__(self, path):
+        # Used from the thread that opened it
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS corners (digest TEXT, board TEXT, settings TEXT, "
+                                "width INTEGER, height INTEGER, corners BLOB, PRIMARY KEY (digest, board, settings))")
+
+    def lookup(self, digest, checkerboard):
+        """(corners, imageSize) with corners None for no chessboard, or None when not cached."""
+        row = self.connection.execute("SELECT width, height, corners FROM corners WHERE digest = ? AND board = ? "
+                                      "AND settings = ?", (digest, repr(checkerboard), self.SETTINGS)).fetchone()
+        if row is None:
+            return None
+        width, height, blob = row
+        corners = np.frombuffer(blob, np.float32).reshape(-1, 1, 2).copy() if blob is not None else None
+        return corners, (width, height)
+
+    def store(self, digest, checkerboard, corners, imageSize):
+        blob = np.ascontiguousarray(corners, np.float32).tobytes() if corners is not None else None
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO corners VALUES (?, ?, ?, ?, ?, ?)",
+                                    (digest, repr(checkerboard), self.SETTINGS, imageSize[0], imageSize[1], blob))
+
+    def load(self, path, checkerboard):
+        """(image, corners) for an image file, the corners from the cache when known.
+        image is None when the file cannot be read."""
+        with open(path, "rb") as file:
+            data = file.read()
+        image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            return None, None
+
+        digest = fileDigest(data)
+        cached = self.lookup(digest, checkerboard)
+        if cached is not None:
+            return image, cached[0]
+
+        corners = findCorners(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), checkerboard)
+        self.store(digest, checkerboard, corners, image.shape[1::-1])
+        return image, corners
+
+    def close(self):
+        self.connection.close()
+
+#---------------------------------------------------------------------
+
+# imageSize is (width, height), error says why a pair has no corners
+PairCorners = collections.namedtuple('PairCorners', ['left', 'right', 'imageSize', 'error'])
+
+
+def detectImage(path, checkerboard):
+    """(corners, imageSize), imageSize None when the file cannot be read."""
+    image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        return None, None
+    return findCorners(image, checkerboard), image.shape[::-1]
+
+
+def pairCorners(leftFile, rightFile, left, right):
+    (leftCorners, imageSize), (rightCorners, rightSize) = left, right
+    if imageSize is None or rightSize is None:
+        return PairCorners(None, None, None, "could not read " + (leftFile if imageSize is None else rightFile))
+
+    if rightSize != imageSize:
+        return PairCorners(None, None, imageSize, f"left is {imageSize}, right is {rightSize}")
+
+    if leftCorners is None or rightCorners is None:
+        missing = ("both images" if leftCorners is None and rightCorners is None else
+                   "left image" if leftCorners is None else "right image")
+        return PairCorners(None, None, imageSize, f"no chessboard in {missing}")
+    return PairCorners(leftCorners, rightCorners, imageSize, None)
+
+
+def initWorker():
+    # One thread per process, the pool already uses all cores
+    cv2.setNumThreads(1)
+
+
+def detectPairs(pairs, checkerboard, workers=None, cache=None):
+    """PairCorners for each (leftFile, rightFile), in the order given. Images the
+    cache knows are not detected again, the rest are detected in parallel on a
+    process pool (workers defaults to the number of cores) and added to it."""
+    files = list(dict.fromkeys(path for pair in pairs for path in pair))
+    results = {}
+    digests = {}
+
+    if cache is not None:
+        for path in files:
+            try:
+                with open(path, "rb") as file:
+                    digests[path] = fileDigest(file.read())
+            except OSError:
+                # Reported as unreadable by the detection
+                continue
+            cached = cache.lookup(digests[path], checkerboard)
+            if cached is not None:
+                results[path] = cached
+
+    missing = [path for path in files if path not in results]
+    if missing:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=initWorker) as executor:
+            for path, result in zip(missing, executor.map(detectImage, missing, itertools.repeat(checkerboard))):
+                results[path] = result
+                if cache is not None and path in digests and result[1] is not None:
+                    cache.store(digests[path], checkerboard, *result)
+
+    for leftFile, rightFile in pairs:
+        yield pairCorners(leftFile, rightFile, results[leftFile], results[rightFile])
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#cython: language_level=3, boundscheck=False
+###############################################################################
+#
+# Stereo calibration files.
+#
+# A calibration is saved as a small binary bundle (an uncompressed .npz) with
+# only the matrices: intrinsics, distortion, R/T, rectification, projection
+# and Q, tagged with a format name and version. The rectification maps are
+# made from them when first needed and cached next to the bundle as .npy
+# files, one pair per resolution, that later loads memory-map instead of
+# computing the maps again.
+#
+# XML files with the full maps, as written before, can still be read.
+#
+###############################################################################
+import glob
+import hashlib
+import os
+
+import cv2
+import numpy as np
+
+BUNDLE_FORMAT = "stereo-calibration"
+BUNDLE_VERSION = 1
+BUNDLE_EXTENSION = ".npz"
+
+#---------------------------------------------------------------------
+
+class StereoCalibration:
+    """The matrices of a calibrated stereo pair, and the rectification maps made from them."""
+
+    MATRICES = ("cameraMatrixLeft", "distCoeffsLeft", "rectificationLeft", "projectionLeft",
+                "cameraMatrixRight", "distCoeffsRight", "rectificationRight", "projectionRight",
+                "rotation", "translation", "Q")
+
+    def __init__(self, imageSize, **matrices):
+        missing = set(self.MATRICES) - set(matrices)
+        if missing:
+            raise ValueError(f"Missing calibration matrices: {', '.join(sorted(missing))}")
+        # (width, height) the calibration was made at
+        self.imageSize = tuple(int(value) for value in imageSize)
+        for name in self.MATRICES:
+            setattr(self, name, np.asarray(matrices[name], np.float64))
+        # Bundle file and its digest, when saved or loaded, for the map cache
+        self.path = None
+        self.digest = None
+
+    @classmethod
+    def fromSolve(cls, result, imageSize):
+        """From the attributes solver.solveStereo returns."""
+        return cls(imageSize,
+                   cameraMatrixLeft=result["newCameraMatrixLeft"], distCoeffsLeft=result["distCoeffsLeft"],
+                   rectificationLeft=result["leftRectification"], projectionLeft=result["projectionMatrixLeft"],
+                   cameraMatrixRight=result["newCameraMatrixRight"], distCoeffsRight=result["distCoeffsRight"],
+                   rectificationRight=result["rightRectification"], projectionRight=result["projectionMatrixRight"],
+                   rotation=result["rotation"], translation=result["translation"], Q=result["Qmatrix"])
+
+    #---------------------------------------------------------------------
+
+    def save(self, path):
+        """Write the bundle, replacing any file at path in one step, and drop maps cached for an older one."""
+        temporary = path + ".tmp"
+        with open(temporary, "wb") as file:
+            np.savez(file, format=np.array(BUNDLE_FORMAT), version=np.array(BUNDLE_VERSION),
+                     imageSize=np.array(self.imageSize),
+                     **{name: getattr(self, name) for name in self.MATRICES})
+        os.replace(temporary, path)
+
+        for sidecar in glob.glob(glob.escape(os.path.splitext(path)[0]) + ".????????????.*x*.map?.npy"):
+            os.remove(sidecar)
+        self.path, self.digest = path, bundleDigest(path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as bundle:
+            if "format" not in bundle or str(bundle["format"]) != BUNDLE_FORMAT:
+                raise ValueError(f"{path} is not a stereo calibration bundle")
+            version = int(bundle["version"])
+            if version > BUNDLE_VERSION:
+                raise ValueError(f"{path} has calibration format version {version}, "
+                                 f"this version reads up to {BUNDLE_VERSION}")
+            calibration = cls(bundle["imageSize"], **{name: bundle[name] for name in cls.MATRICES})
+        calibration.path, calibration.digest = path, bundleDigest(path)
+        return calibration
+
+    #---------------------------------------------------------------------
+
+    def scaled(self, imageSize):
+        """The calibration for frames of another resolution, the same cameras scaled."""
+        scaleX, scaleY = imageSize[0] / self.imageSize[0], imageSize[1] / self.imageSize[1]
+        scale = np.diag([scaleX, scaleY, 1.0])
+        matrices = {name: getattr(self, name) for name in self.MATRICES}
+        for name in ("cameraMatrixLeft", "cameraMatrixRight", "projectionLeft", "projectionRight"):
+            matrices[name] = scale @ matrices[name]
+
+        # Q maps (x, y, d, 1) at the new scale back to the same 3D points
+        matrices["Q"] = self.Q @ np.diag([1.0 / scaleX, 1.0 / scaleY, 1.0 / scaleX, 1.0])
+        return StereoCalibration(imageSize, **matrices)
+
+    def computeMaps(self):
+        return tuple(cv2.initUndistortRectifyMap(getattr(self, "cameraMatrix" + side), getattr(self, "distCoeffs" + side),
+                                                 getattr(self, "rectification" + side),
+                                                 getattr(self, "projection" + side), self.imageSize, cv2.CV_16SC2)
+                     for side in ("Left", "Right"))
+
+    def maps(self, imageSize=None):
+        """(leftStereoMap, rightStereoMap) as fixed point (map1, map2) pairs, at the
+        calibrated resolution unless imageSize is given. For a saved or loaded bundle
+        they come memory-mapped from the cache next to it, made there the first time."""
+        imageSize = self.imageSize if imageSize is None else tuple(imageSize)
+        calibration = self if imageSize == self.imageSize else self.scaled(imageSize)
+        if self.path is None:
+            return calibration.computeMaps()
+
+        # Keyed by the bundle contents too, so a recalibration never uses stale maps
+        root = f"{os.path.splitext(self.path)[0]}.{self.digest[:12]}.{imageSize[0]}x{imageSize[1]}"
+        xyPath, fractionPath = root + ".map1.npy", root + ".map2.npy"
+        if not (os.path.exists(xyPath) and os.path.exists(fractionPath)):
+            maps = calibration.computeMaps()
+            (leftXY, leftFraction), (rightXY, rightFraction) = maps
+            try:
+                # Written under a temporary name first, a reader never sees half a file
+                for sidecarPath, both in ((fractionPath, (leftFraction, rightFraction)), (xyPath, (leftXY, rightXY))):
+                    with open(sidecarPath + ".tmp", "wb") as file:
+                        np.save(file, np.stack(both))
+                    os.replace(sidecarPath + ".tmp", sidecarPath)
+            except OSError:
+                # Say a read-only folder, then the maps are made on every load
+                return maps
+
+        xy = np.load(xyPath, mmap_mode="r")
+        fraction = np.load(fractionPath, mmap_mode="r")
+        return (xy[0], fraction[0]), (xy[1], fraction[1])
+
+#---------------------------------------------------------------------
+
+def bundleDigest(path):
+    with open(path, "rb") as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+
+def isBundle(path):
+    return not path.lower().endswith(".xml")
+
+
+def loadXmlMaps(path):
+    """(leftStereoMap, rightStereoMap, Q) from an XML file with the full maps, Q None
+    in files written before it was stored."""
+    file = cv2.FileStorage(path, cv2.FILE_STORAGE_READ)
+    leftStereoMap = (file.getNode("Left_Stereo_Map_x").mat(), file.getNode("Left_Stereo_Map_y").mat())
+    rightStereoMap = (file.getNode("Right_Stereo_Map_x").mat(), file.getNode("Right_Stereo_Map_y").mat())
+    Q = file.getNode("disparity_to_depth_matrix").mat()
+    file.release()
+    return leftStereoMap, rightStereoMap, Q
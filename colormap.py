@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#cython: language_level=3, boundscheck=False
+###############################################################################
+#
+# Disparity to color for display, through a precomputed lookup table.
+#
+###############################################################################
+import cv2
+import numpy as np
+
+#---------------------------------------------------------------------
+
+class DisparityRenderer:
+    """Disparity (16-bit fixed point) to a color image.
+
+    The table holds black for unmatched pixels, then the colors over the
+    disparity range, already in the channel order of the display (RGB for wx,
+    BGR for cv2.imshow). A frame is one saturating scale to a table index and
+    one lookup, into buffers reused while the frame size stays the same.
+
+    With 256 entries the lookup is applyColorMap with the table as user colors.
+    4096 entries give every 1/16 pixel step of up to 256 disparities its own
+    color, at about twice the cost."""
+
+    def __init__(self, colormap=cv2.COLORMAP_JET, entries=256, rgb=False):
+        if entries not in (256, 4096):
+            raise ValueError(f"Unsupported table size {entries}, expected 256 or 4096")
+        self.entries = entries
+
+        gradient = np.linspace(0, 255, entries - 1).round().astype(np.uint8).reshape(-1, 1)
+        colors = cv2.applyColorMap(gradient, colormap).reshape(-1, 3)
+        if rgb:
+            colors = colors[:, ::-1]
+
+        # Entry 0 is for unmatched pixels. The wide table has a padding channel so
+        # an entry is one uint32
+        self.table = np.zeros((entries, 1, 3 if entries == 256 else 4), np.uint8)
+        self.table[1:, 0, :3] = colors
+        self.packedTable = self.table.view(np.uint32).reshape(-1) if entries > 256 else None
+
+        self.index = None
+        self.packed = None
+        self.output = None
+
+    def render(self, disparity, minDisparity, numDisparities):
+        """Reused buffer, valid until the next call."""
+        if self.output is None or self.output.shape[:2] != disparity.shape:
+            self.index = np.empty(disparity.shape, np.uint8 if self.entries == 256 else np.uint16)
+            self.output = np.empty(disparity.shape + (3,), np.uint8)
+            if self.packedTable is not None:
+                self.packed = np.empty(disparity.shape, np.uint32)
+
+        # minDisparity to entry 1 and the end of the range to the last entry. Anything
+        # below, unmatched pixels included, saturates to 0
+        scale = (self.entries - 2) / (16.0 * numDisparities)
+        cv2.addWeighted(disparity, scale, disparity, 0, 1.0 - 16 * minDisparity * scale, dst=self.index,
+                        dtype=cv2.CV_8U if self.entries == 256 else cv2.CV_16U)
+
+        if self.packedTable is None:
+            return cv2.applyColorMap(self.index, self.table, dst=self.output)
+
+        np.minimum(self.index, self.entries - 1, out=self.index)
+        np.take(self.packedTable, self.index, out=self.packed)
+        return cv2.cvtColor(self.packed.view(np.uint8).reshape(disparity.shape + (4,)), cv2.COLOR_RGBA2RGB,
+                            dst=self.output)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#cython: language_level=3, boundscheck=False
+###############################################################################
+#
+# Depth and point clouds from disparity, with the Q matrix from stereoRectify.
+#
+# The chessboard object points are in squares, so Q measures in squares too.
+# squareSize (say in mm) turns that into metric units.
+#
+###############################################################################
+import os
+
+import cv2
+import numpy as np
+
+#---------------------------------------------------------------------
+
+class DepthStage:
+    """Disparity (16-bit fixed point, as the matchers return it) to depth and 3D points.
+    The outputs are reused buffers, valid until the next call."""
+
+    def __init__(self, Q, squareSize=1.0):
+        self.Q = np.asarray(Q, np.float64)
+        self.squareSize = squareSize
+        self.buffers = {}
+
+    def buffer(self, name, shape):
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != shape:
+            buffer = self.buffers[name] = np.empty(shape, np.float32)
+        return buffer
+
+    def disparity(self, fixedPoint):
+        return np.multiply(fixedPoint, 1.0 / 16.0, out=self.buffer("disparity", fixedPoint.shape), casting="unsafe")
+
+    def matched(self, disparity):
+        """Mask of the pixels with a match and a finite depth. Besides no match (disparity
+        <= 0), the disparity where Q[3,2] * d + Q[3,3] is 0 maps to infinity."""
+        return (disparity > 0) & (self.Q[3, 2] * disparity + self.Q[3, 3] != 0)
+
+    def depthAt(self, fixedPoint):
+        """Depth for one disparity value, None when there is no match."""
+        disparity = fixedPoint / 16.0
+        denominator = self.Q[3, 2] * disparity + self.Q[3, 3]
+        if disparity <= 0 or denominator == 0:
+            return None
+        return self.Q[2, 3] / denominator * self.squareSize
+
+    def depth(self, fixedPoint):
+        """Depth image, 0 where there is no match. Only Z is needed, so this skips
+        reprojectImageTo3D: Z = Q[2,3] / (Q[3,2] * d + Q[3,3])."""
+        disparity = self.disparity(fixedPoint)
+        depth = self.buffer("depth", disparity.shape)
+        np.multiply(disparity, self.Q[3, 2], out=depth)
+        np.add(depth, self.Q[3, 3], out=depth)
+        invalid = (disparity <= 0) | (depth == 0)
+        np.divide(self.Q[2, 3] * self.squareSize, depth, out=depth, where=~invalid)
+        depth[invalid] = 0
+        return depth
+
+    def points(self, fixedPoint):
+        """(points, valid): an H x W x 3 image of 3D points and the mask of pixels with a match."""
+        disparity = self.disparity(fixedPoint)
+        points = self.buffer("points", disparity.shape + (3,))
+        cv2.reprojectImageTo3D(disparity, self.Q, _3dImage=points)
+        if self.squareSize != 1.0:
+            np.multiply(points, self.squareSize, out=points)
+        return points, self.matched(disparity)
+
+    def pointCloud(self, fixedPoint, colors=None, voxelSize=None):
+        """(points, colors) as N x 3 arrays of the matched pixels, colors BGR or None.
+        With voxelSize, points in the same voxel are merged into their mean."""
+        points, valid = self.points(fixedPoint)
+        cloud = points[valid]
+        cloudColors = colors[valid] if colors is not None else None
+        if voxelSize:
+            cloud, cloudColors = voxelDownsample(cloud, cloudColors, voxelSize)
+        return cloud, cloudColors
+
+#---------------------------------------------------------------------
+
+def voxelDownsample(points, colors, voxelSize):
+    """Mean point (and color) of each occupied voxel."""
+    if not len(points):
+        return points, colors
+
+    cells = np.floor(points / voxelSize).astype(np.int64)
+    cells -= cells.min(axis=0)
+    # One integer per voxel, cheaper to sort than rows
+    extent = cells.max(axis=0) + 1
+    keys = (cells[:, 0] * extent[1] + cells[:, 1]) * extent[2] + cells[:, 2]
+    _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+
+    def mean(values):
+        sums = np.stack([np.bincount(inverse, weights=values[:, i], minlength=len(counts))
+                         for i in range(values.shape[1])], axis=1)
+        return sums / counts[:, None]
+
+    merged = mean(points).astype(np.float32)
+    mergedColors = np.rint(mean(colors)).astype(np.uint8) if colors is not None else None
+    return merged, mergedColors
+
+#---------------------------------------------------------------------
+
+CLOUD_FORMATS = ("ply", "npy")
+
+
+def cloudRecord(points, colors):
+    if colors is None:
+        record = np.empty(len(points), [('x', '<f4'), ('y', '<f4'), ('z', '<f4')])
+    else:
+        record = np.empty(len(points), [('x', '<f4'), ('y', '<f4'), ('z', '<f4'),
+                                        ('red', 'u1'), ('green', 'u1'), ('blue', 'u1')])
+        # Colors come from OpenCV images
+        record['red'] = colors[:, 2]
+        record['green'] = colors[:, 1]
+        record['blue'] = colors[:, 0]
+    record['x'] = points[:, 0]
+    record['y'] = points[:, 1]
+    record['z'] = points[:, 2]
+    return record
+
+
+def writePly(path, points, colors=None):
+    record = cloudRecord(points, colors)
+    header = ["ply", "format binary_little_endian 1.0", f"element vertex {len(record)}"]
+    header += [f"property {'float' if record.dtype[name] == np.float32 else 'uchar'} {name}"
+               for name in record.dtype.names]
+    header.append("end_header\n")
+    with open(path, "wb") as file:
+        file.write("\n".join(header).encode("ascii"))
+        record.tofile(file)
+
+
+class CloudWriter:
+    """Writes one point cloud file per frame, binary PLY or NPY (a structured array)."""
+
+    def __init__(self, directory, format="ply"):
+        if format not in CLOUD_FORMATS:
+            raise ValueError(f"Unknown point cloud format {format}, expected one of {', '.join(CLOUD_FORMATS)}")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.format = format
+        self.frame = 0
+
+    def write(self, points, colors=None):
+        path = os.path.join(self.directory, f"cloud_{self.frame:06d}.{self.format}")
+        if self.format == "ply":
+            writePly(path, points, colors)
+        else:
+            np.save(path, cloudRecord(points, colors))
+        self.frame += 1
+        return path
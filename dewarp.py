@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#cython: language_level=3, boundscheck=False
+###############################################################################
+#
+# Precomputed dewarp plans for converting 360 degree frames to panoramic.
+#
+# The projection geometry of a video never changes between frames, so the
+# remap tables are built once per resolution (with the 90 degree rotation
+# folded in) and every frame then costs a single cv.remap.
+#
+# With the default linear polar projection the output matches warpPolar +
+# ROTATE_90_CLOCKWISE pixel for pixel, odd frame sizes included, except that
+# samples outside the frame come out black; warpPolar leaves those pixels of
+# its output unset.
+#
+###############################################################################
+import hashlib
+import logging
+import os
+
+import cv2 as cv
+import numpy as np
+
+from projections import LinearPolar
+
+logger = logging.getLogger('dewarp')
+
+defaultCacheDir = os.path.expanduser("~/.cache/threesixty")
+
+# Bump when the map layout changes, so stale cache files are not picked up
+PLAN_VERSION = 3
+
+# Plans already built in this process, by key
+_plans = {}
+
+#---------------------------------------------------------------------
+
+class DewarpPlan:
+    """Fixed-point remap tables for one input size and projection."""
+
+    def __init__(self, inputSize, projection=None, interpolation=cv.INTER_NEAREST):
+        width, height = inputSize
+        self.inputSize = (int(width), int(height))
+        self.projection = projection if projection is not None else LinearPolar()
+        self.center, self.maxRadius, self.outputSize = self.projection.resolve(self.inputSize)
+        self.interpolation = interpolation
+        self.map1 = None
+        self.map2 = None
+
+    #---------------------------------------------------------------------
+
+    def key(self):
+        description = f"{PLAN_VERSION}:{self.inputSize}:{self.projection.key(self.inputSize)}:{self.interpolation}"
+        return hashlib.sha1(description.encode()).hexdigest()
+
+    def buildMaps(self):
+        mapX, mapY = self.projection.maps(self.inputSize)
+        self.map1, self.map2 = cv.convertMaps(mapX, mapY, cv.CV_16SC2,
+                                              nninterpolation=self.interpolation == cv.INTER_NEAREST)
+        return self
+
+    #---------------------------------------------------------------------
+
+    def cacheFile(self, cacheDir):
+        return os.path.join(cacheDir, "dewarp_" + self.key() + ".npz")
+
+    def load(self, cacheDir):
+        path = self.cacheFile(cacheDir)
+        if not os.path.exists(path):
+            return False
+
+        try:
+            with np.load(path) as data:
+                self.map1 = data["map1"]
+                self.map2 = data["map2"] if data["map2"].size else None
+        except Exception as e:
+            logger.warning(f"Could not read dewarp plan {path}: {e}")
+            return False
+        return True
+
+    def save(self, cacheDir):
+        os.makedirs(cacheDir, exist_ok=True)
+        path = self.cacheFile(cacheDir)
+        # Several converter processes may build the same plan at once
+        tmpPath = f"{path}.{os.getpid()}.tmp.npz"
+
+        map2 = self.map2 if self.map2 is not None else np.empty(0, np.uint16)
+        np.savez(tmpPath, map1=self.map1, map2=map2)
+        os.replace(tmpPath, path)
+
+    #---------------------------------------------------------------------
+
+    @classmethod
+    def forFrame(cls, frame, cacheDir=defaultCacheDir, **kwargs):
+        """Get a ready plan for frames shaped like this one, from memory or the disk cache if possible."""
+        height, width = frame.shape[:2]
+        plan = cls((width, height), **kwargs)
+
+        key = plan.key()
+        if key in _plans:
+            return _plans[key]
+
+        if cacheDir is None or not plan.load(cacheDir):
+            plan.buildMaps()
+            if cacheDir is not None:
+                try:
+                    plan.save(cacheDir)
+                except OSError as e:
+                    logger.warning(f"Could not cache dewarp plan: {e}")
+
+        _plans[key] = plan
+        return plan
+
+    def apply(self, frame, out=None):
+        return cv.remap(frame, self.map1, self.map2, self.interpolation, dst=out,
+                        borderMode=cv.BORDER_CONSTANT, borderValue=0)
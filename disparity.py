@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#cython: language_level=3, boundscheck=False
+###############################################################################
+#
+# Disparity matching shared by the stereo viewers.
+#
+###############################################################################
+import collections
+import concurrent.futures
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+# Coarse to fine matching: pyramid levels matched below full resolution first
+MATCHING_MODES = {
+    "plain": 0,
+    "pyramid 1/2": 1,
+    "pyramid 1/4": 2,
+}
+
+#---------------------------------------------------------------------
+
+class StereoParameters:
+    """Matcher parameters, changed from GUI events. The version goes up on every
+    real change, so the video loop can tell without comparing values."""
+
+    def __init__(self, **values):
+        self.values = dict(values)
+        self.version = 0
+        self.lock = threading.Lock()
+
+    def set(self, name, value):
+        with self.lock:
+            if self.values.get(name) != value:
+                self.values[name] = value
+                self.version += 1
+
+    def snapshot(self):
+        """(version, key) where key is a hashable copy of the values."""
+        with self.lock:
+            return self.version, tuple(sorted(self.values.items()))
+
+#---------------------------------------------------------------------
+
+def configureMatcher(matcher, parameters):
+    # StereoSGBM has no pre-filter type / size or texture threshold, so
+    # parameters without a setter are skipped
+    for name, value in parameters:
+        setter = getattr(matcher, "set" + name[0].upper() + name[1:], None)
+        if setter is not None:
+            setter(value)
+    return matcher
+
+
+class MatcherPool:
+    """Ready matchers for the last few configurations, least recently used dropped first.
+    Going back to a recent preset reuses its matcher instead of reconfiguring one."""
+
+    def __init__(self, create=cv2.StereoBM_create, size=4):
+        self.create = create
+        self.size = size
+        self.matchers = collections.OrderedDict()
+        self.version = None
+        self.current = None
+
+    def get(self, parameters):
+        version, key = parameters.snapshot()
+        if version == self.version:
+            return self.current
+
+        self.version = version
+        self.current = self.lookup(key)
+        return self.current
+
+    def lookup(self, key):
+        """Matcher for key, a sorted tuple of (name, value), configured if it is not in the pool."""
+        matcher = self.matchers.pop(key, None)
+        if matcher is None:
+            matcher = configureMatcher(self.create(), key)
+
+        self.matchers[key] = matcher
+        while len(self.matchers) > self.size:
+            self.matchers.popitem(last=False)
+        return matcher
+
+#---------------------------------------------------------------------
+
+def usableCores():
+    """Cores this process may run on, which can be fewer than os.cpu_count()."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+class StripDisparityEngine:
+    """Matches the rectified pair in horizontal bands on a thread pool and
+    stitches the bands back into one disparity map.
+
+    Each band is matched with a margin of blockSize + numDisparities rows of
+    context on either side, so away from the image border the result is the
+    same as one compute() over the whole frame. Every band has its own
+    matchers, since a matcher keeps internal buffers and cannot be shared
+    between threads.
+
+    There is one band per usable core by default, so one band (a single
+    compute) on a single core. With several bands the OpenCV threads are cut
+    to cores // bands, as the matchers run their own threads inside each band
+    and would otherwise oversubscribe the CPU."""
+
+    def __init__(self, parameters, create=cv2.StereoBM_create, bands=None, poolSize=4):
+        cores = usableCores()
+        if bands is None:
+            bands = cores
+        if bands < 1:
+            raise ValueError(f"Need at least one band, got {bands}")
+        self.parameters = parameters
+        self.bands = bands
+        if bands > 1:
+            cv2.setNumThreads(max(1, cores // bands))
+        self.pools = [MatcherPool(create, poolSize) for _ in range(self.bands)]
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.bands,
+                                                              thread_name_prefix="disparity") if self.bands > 1 else None
+        self.output = None
+
+    def margin(self):
+        values = dict(self.parameters.snapshot()[1])
+        return values.get("blockSize", 21) + values.get("numDisparities", 16)
+
+    def compute(self, left, right):
+        """Disparity as returned by the matchers (16-bit fixed point). The result is
+        a reused buffer, valid until the next call."""
+        matchers = [pool.get(self.parameters) for pool in self.pools]
+        height = left.shape[0]
+        margin = self.margin()
+
+        if self.executor is None or height < self.bands * 2 * margin:
+            # Too small for bands to pay off
+            return matchers[0].compute(left, right)
+
+        if self.output is None or self.output.shape != left.shape[:2]:
+            self.output = np.empty(left.shape[:2], np.int16)
+
+        def matchBand(band):
+            top = height * band // self.bands
+            bottom = height * (band + 1) // self.bands
+            start = max(0, top - margin)
+            end = min(height, bottom + margin)
+            disparity = matchers[band].compute(left[start:end], right[start:end])
+            self.output[top:bottom] = disparity[top - start:bottom - start]
+
+        for future in [self.executor.submit(matchBand, band) for band in range(self.bands)]:
+            future.result()
+        return self.output
+
+#---------------------------------------------------------------------
+
+def withValues(key, **values):
+    merged = dict(key)
+    merged.update(values)
+    return tuple(sorted(merged.items()))
+
+
+def roundUp(value, multiple):
+    return max(multiple, -(-value // multiple) * multiple)
+
+
+class PyramidDisparityEngine:
+    """Coarse to fine matching. The pair is matched at 1/2 or 1/4 resolution
+    first, then each full resolution tile is only searched over the disparities
+    found for it there (plus slack), instead of the whole numDisparities range.
+
+    The matchers only take one search range per call, so the range is set per
+    tile rather than per pixel. A tile where the coarse level found nothing is
+    searched over the full range."""
+
+    def __init__(self, parameters, create=cv2.StereoBM_create, levels=1, tileSize=128, poolSize=64):
+        self.parameters = parameters
+        self.levels = levels
+        self.tileSize = tileSize
+        # Tiles ask for many different ranges, so the pool is large
+        self.matchers = MatcherPool(create, poolSize)
+        self.output = None
+        self.tiles = 0
+        self.searched = 0
+
+    def setLevels(self, levels):
+        if levels not in MATCHING_MODES.values():
+            raise ValueError(f"Unsupported pyramid levels {levels}, expected one of {sorted(MATCHING_MODES.values())}")
+        self.levels = levels
+
+    def coarseDisparity(self, left, right, key, factor):
+        for _ in range(self.levels):
+            left = cv2.pyrDown(left)
+            right = cv2.pyrDown(right)
+
+        matcher = self.matchers.lookup(key)
+        coarseMin = matcher.getMinDisparity() // factor
+        coarseCount = roundUp(matcher.getNumDisparities() // factor, 16)
+        coarseBlock = max(5, matcher.getBlockSize() // factor | 1)
+        if left.shape[1] - (coarseMin + coarseCount) <= coarseBlock:
+            # Too narrow to match at this level
+            return None, coarseMin
+
+        coarseKey = withValues(key, minDisparity=coarseMin, numDisparities=coarseCount, blockSize=coarseBlock)
+        return self.matchers.lookup(coarseKey).compute(left, right), coarseMin
+
+    def tileRange(self, prior, coarseMin, factor, minDisparity, numDisparities, right):
+        # Search range (minDisparity, numDisparities) for a tile from its coarse disparities.
+        # Nothing in the tile can be further than its right edge from the image border.
+        low = minDisparity
+        high = min(minDisparity + numDisparities, max(minDisparity + 1, right))
+
+        prior = prior[prior >= coarseMin * 16]
+        if prior.size:
+            # Percentiles, so a few mismatches at the coarse level do not open up the whole range
+            lowest, highest = np.percentile(prior, (2, 98))
+            slack = 2 * factor
+            low = max(low, int(lowest) * factor // 16 - slack)
+            high = max(low + 1, min(high, -(-int(highest) * factor // 16) + slack))
+
+        count = min(numDisparities, roundUp(high - low, 16))
+        return min(low, minDisparity + numDisparities - count), count
+
+    def compute(self, left, right):
+        """Disparity in the same 16-bit fixed point as a plain compute(), invalid pixels
+        at (minDisparity - 1) * 16. The result is a reused buffer, valid until the next call."""
+        if self.levels == 0:
+            return self.matchers.get(self.parameters).compute(left, right)
+
+        _, key = self.parameters.snapshot()
+        matcher = self.matchers.lookup(key)
+        minDisparity = matcher.getMinDisparity()
+        numDisparities = matcher.getNumDisparities()
+        blockSize = matcher.getBlockSize()
+        invalid = (minDisparity - 1) * 16
+
+        factor = 2 ** self.levels
+        coarse, coarseMin = self.coarseDisparity(left, right, key, factor)
+        if coarse is None:
+            return matcher.compute(left, right)
+
+        height, width = left.shape[:2]
+        if self.output is None or self.output.shape != (height, width):
+            self.output = np.empty((height, width), np.int16)
+
+        self.tiles = 0
+        self.searched = 0
+        for y0 in range(0, height, self.tileSize):
+            y1 = min(height, y0 + self.tileSize)
+            for x0 in range(0, width, self.tileSize):
+                x1 = min(width, x0 + self.tileSize)
+                prior = coarse[y0 // factor:-(-y1 // factor), x0 // factor:-(-x1 // factor)]
+                low, count = self.tileRange(prior, coarseMin, factor, minDisparity, numDisparities, x1)
+                self.tiles += 1
+                self.searched += count
+
+                # Block context around the tile, and the search range to its left (or right)
+                top = max(0, y0 - blockSize)
+                bottom = min(height, y1 + blockSize)
+                start = max(0, x0 - max(0, low + count) - blockSize)
+                end = min(width, x1 + blockSize + max(0, -low))
+                # SGBM refuses crops narrower than the search range, so tiles near the left edge are widened
+                end = min(width, max(end, start + max(0, low + count) + blockSize + 1))
+
+                tileMatcher = self.matchers.lookup(withValues(key, minDisparity=low, numDisparities=count))
+                disparity = tileMatcher.compute(left[top:bottom, start:end], right[top:bottom, start:end])
+                disparity = disparity[y0 - top:y1 - top, x0 - start:x1 - start]
+                # Each tile marks invalid pixels below its own range
+                np.copyto(self.output[y0:y1, x0:x1], np.where(disparity < low * 16, invalid, disparity))
+
+        return self.output
+
+    def searchFraction(self):
+        """Mean search range of the tiles in the last compute(), as a fraction of numDisparities."""
+        numDisparities = self.matchers.lookup(self.parameters.snapshot()[1]).getNumDisparities()
+        return self.searched / (self.tiles * numDisparities) if self.tiles else 1.0
+
+    #---------------------------------------------------------------------
+
+    def compare(self, left, right, repeats=5):
+        """Speed and agreement of every matching mode against plain matching, on one rectified pair."""
+        plainMatcher = self.matchers.lookup(self.parameters.snapshot()[1])
+        invalid = (plainMatcher.getMinDisparity() - 1) * 16
+        plain = plainMatcher.compute(left, right)
+        valid = plain > invalid
+        results = {}
+        savedLevels = self.levels
+
+        try:
+            for mode, levels in MATCHING_MODES.items():
+                self.levels = levels
+                start = time.perf_counter()
+                for _ in range(repeats):
+                    disparity = self.compute(left, right)
+                milliseconds = (time.perf_counter() - start) / repeats * 1000.0
+
+                error = np.abs(plain[valid].astype(np.int32) - disparity[valid]) / 16.0
+                results[mode] = {
+                    "ms": milliseconds,
+                    "search": self.searchFraction() if levels else 1.0,
+                    "within 1px": float((error <= 1.0).mean()) if error.size else 1.0,
+                    "mean error": float(error.mean()) if error.size else 0.0,
+                }
+        finally:
+            self.levels = savedLevels
+
+        return results
+
+
+def formatComparison(results):
+    columns = list(next(iter(results.values())))
+    lines = [f"{'':12s}" + "".join(f"{column:>12s}" for column in columns)]
+    for mode, row in results.items():
+        lines.append(f"{mode:12s}" + "".join(f"{row[column]:12.3f}" for column in columns))
+    return "\n".join(lines)
+
+#---------------------------------------------------------------------
+
+class TemporalDisparityEngine:
+    """Reuses the disparity of tiles where neither image changed, for mostly
+    static scenes.
+
+    A tile of the left image is matched again when it changed, or when the right
+    image changed anywhere its pixels can match (the disparity range to its left),
+    plus one tile around that for the block context. Tiles are compared with the
+    frame they were last matched from rather than the previous frame, so a slow
+    drift still adds up to a change. Everything is matched again after a parameter
+    change and every refresh frames."""
+
+    def __init__(self, parameters, create=cv2.StereoBM_create, tileSize=64, noise=12, changedPixels=0.002,
+                 refresh=100):
+        self.parameters = parameters
+        self.tileSize = tileSize
+        # A pixel has changed when it differs by more than noise gray levels, a tile when
+        # more than changedPixels of its pixels have
+        self.noise = noise
+        self.changedPixels = changedPixels
+        self.refresh = refresh
+        self.matchers = MatcherPool(create)
+
+        self.referenceLeft = None
+        self.referenceRight = None
+        self.output = None
+        self.version = None
+        self.frames = 0
+        self.reused = 0.0
+        self.tilesReused = 0
+        self.tilesTotal = 0
+
+    def changedTiles(self, image, reference, grid):
+        changed = cv2.threshold(cv2.absdiff(image, reference), self.noise, 1.0, cv2.THRESH_BINARY)[1]
+        fraction = cv2.resize(changed.astype(np.float32), (grid[1], grid[0]), interpolation=cv2.INTER_AREA)
+        return fraction > self.changedPixels
+
+    def affectedTiles(self, changedLeft, changedRight, minDisparity, maxDisparity):
+        affected = changedLeft.copy()
+        columns = affected.shape[1]
+        # A left pixel at x matches right pixels from x - maxDisparity to x - minDisparity
+        for shift in range(minDisparity // self.tileSize, -(-maxDisparity // self.tileSize) + 1):
+            if shift >= 0:
+                affected[:, shift:] |= changedRight[:, :columns - shift]
+            else:
+                affected[:, :shift] |= changedRight[:, -shift:]
+        return cv2.dilate(affected.astype(np.uint8), np.ones((3, 3), np.uint8)).astype(bool)
+
+    def matchRun(self, matcher, left, right, rows, columns, minDisparity, maxDisparity, blockSize):
+        # Match a run of tiles, with the same context a whole frame would give them
+        height, width = left.shape[:2]
+        y0, y1 = rows
+        x0, x1 = columns
+        top = max(0, y0 - blockSize)
+        bottom = min(height, y1 + blockSize)
+        start = max(0, x0 - max(0, maxDisparity) - blockSize)
+        end = min(width, x1 + blockSize + max(0, -minDisparity))
+        end = min(width, max(end, start + max(0, maxDisparity) + blockSize + 1))
+
+        disparity = matcher.compute(left[top:bottom, start:end], right[top:bottom, start:end])
+        self.output[y0:y1, x0:x1] = disparity[y0 - top:y1 - top, x0 - start:x1 - start]
+
+    def compute(self, left, right, engine=None):
+        """Disparity of a rectified pair. engine matches whole frames when everything has
+        to be matched again (a plain matcher by default). The result is a reused buffer,
+        valid until the next call."""
+        height, width = left.shape[:2]
+        grid = (-(-height // self.tileSize), -(-width // self.tileSize))
+        version, _ = self.parameters.snapshot()
+        matcher = self.matchers.get(self.parameters)
+
+        full = (self.output is None or self.output.shape != (height, width) or version != self.version or
+                (self.refresh and self.frames % self.refresh == 0))
+        if not full:
+            changedLeft = self.changedTiles(left, self.referenceLeft, grid)
+            changedRight = self.changedTiles(right, self.referenceRight, grid)
+            minDisparity = matcher.getMinDisparity()
+            maxDisparity = minDisparity + matcher.getNumDisparities()
+            affected = self.affectedTiles(changedLeft, changedRight, minDisparity, maxDisparity)
+            # Past about half the frame, the context around the runs costs more than it saves
+            full = affected.mean() > 0.5
+
+        if full:
+            disparity = (engine or matcher).compute(left, right)
+            if self.output is None or self.output.shape != (height, width):
+                self.output = np.empty((height, width), np.int16)
+                self.referenceLeft = np.empty_like(left)
+                self.referenceRight = np.empty_like(right)
+            np.copyto(self.output, disparity)
+            np.copyto(self.referenceLeft, left)
+            np.copyto(self.referenceRight, right)
+            affected = np.ones(grid, bool)
+        else:
+            blockSize = matcher.getBlockSize()
+            for row in range(grid[0]):
+                rows = (row * self.tileSize, min(height, (row + 1) * self.tileSize))
+                # Neighbouring tiles are matched together, so their context is only matched once
+                column = 0
+                while column < grid[1]:
+                    if not affected[row, column]:
+                        column += 1
+                        continue
+                    first = column
+                    while column < grid[1] and affected[row, column]:
+                        column += 1
+                    columns = (first * self.tileSize, min(width, column * self.tileSize))
+                    self.matchRun(matcher, left, right, rows, columns, minDisparity, maxDisparity, blockSize)
+
+            # Only the tiles that changed move their reference on
+            for image, reference, changed in ((left, self.referenceLeft, changedLeft),
+                                              (right, self.referenceRight, changedRight)):
+                mask = cv2.resize(changed.astype(np.uint8), (grid[1] * self.tileSize, grid[0] * self.tileSize),
+                                  interpolation=cv2.INTER_NEAREST)[:height, :width]
+                np.copyto(reference, image, where=mask.astype(bool))
+
+        self.version = version
+        self.frames += 1
+        self.reused = 1.0 - affected.mean()
+        self.tilesReused += int(affected.size - affected.sum())
+        self.tilesTotal += affected.size
+        return self.output
+
+    def report(self):
+        overall = self.tilesReused / self.tilesTotal if self.tilesTotal else 0.0
+        return f"{self.frames} frames, tiles reused last frame {self.reused:.0%} overall {overall:.0%}"
@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#cython: language_level=3, boundscheck=False
+###############################################################################
+#
+# Conversion of Kodak360P 360 degree video files to panoramic video
+#
+###############################################################################
+import concurrent.futures
+import glob
+import json
+import logging
+import os
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+import cv2 as cv
+
+from dewarp import DewarpPlan
+
+logger = logging.getLogger('panorama')
+
+FOURCC = 'MP4V'
+
+# Files a batch takes from a directory or glob
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".avi", ".mkv", ".m4v", ".mts", ".mpg", ".mpeg", ".webm", ".wmv")
+
+#---------------------------------------------------------------------
+
+def openWriter(outputFile, fps, frame):
+    return cv.VideoWriter(outputFile, cv.VideoWriter_fourcc(*FOURCC), fps, frame.shape[1::-1])
+
+#---------------------------------------------------------------------
+
+def convertRange(inputFile, outputFile, startFrame=0, endFrame=None, projection=None):
+    """Dewarp frames [startFrame, endFrame) of the input, endFrame None meaning the end of file.
+    Returns the number of frames written."""
+    cap = cv.VideoCapture(inputFile)
+    if not cap.isOpened():
+        raise RuntimeError(f"Could not open {inputFile}")
+
+    if startFrame:
+        cap.set(cv.CAP_PROP_POS_FRAMES, startFrame)
+        position = int(cap.get(cv.CAP_PROP_POS_FRAMES))
+        if position != startFrame:
+            cap.release()
+            raise RuntimeError(f"Seek to frame {startFrame} of {inputFile} landed on {position}")
+
+    fps = cap.get(cv.CAP_PROP_FPS)
+    outFile = None
+    plan = None
+    output_image = None
+    frameNumber = startFrame
+
+    while cap.isOpened() and (endFrame is None or frameNumber < endFrame):
+        success, input_image = cap.read()
+
+        if input_image is None:
+            break
+
+        if plan is None:
+            plan = DewarpPlan.forFrame(input_image, projection=projection)
+
+        output_image = plan.apply(input_image, output_image)
+
+        if outFile is None:
+            outFile = openWriter(outputFile, fps, output_image)
+        outFile.write(output_image)
+        frameNumber += 1
+
+    cap.release()
+    if outFile is not None:
+        outFile.release()
+
+    return frameNumber - startFrame
+
+#---------------------------------------------------------------------
+
+def splitFrames(frameCount, parts):
+    """Split [0, frameCount) into contiguous ranges, the last one left open ended."""
+    chunk = frameCount // parts
+    ranges = [(i * chunk, (i + 1) * chunk) for i in range(parts)]
+    # The container frame count is only an estimate, so the last range reads to the end
+    ranges[-1] = (ranges[-1][0], None)
+    return ranges
+
+#---------------------------------------------------------------------
+
+def joinSegments(segmentFiles, outputFile):
+    """Concatenate segment files, in order, into the output file."""
+    ffmpeg = shutil.which("ffmpeg")
+
+    if ffmpeg is not None:
+        listFile = os.path.join(os.path.dirname(segmentFiles[0]), "segments.txt")
+        with open(listFile, "w") as f:
+            for segment in segmentFiles:
+                f.write(f"file '{os.path.abspath(segment)}'\n")
+
+        subprocess.run([ffmpeg, "-y", "-loglevel", "error", "-f", "concat", "-safe", "0",
+                        "-i", listFile, "-c", "copy", outputFile], check=True)
+        return
+
+    # No ffmpeg, so the segments have to be decoded and encoded again
+    logger.warning("ffmpeg not found, re-encoding segments to join them")
+    outFile = None
+    for segment in segmentFiles:
+        cap = cv.VideoCapture(segment)
+        fps = cap.get(cv.CAP_PROP_FPS)
+        while True:
+            success, frame = cap.read()
+            if frame is None:
+                break
+            if outFile is None:
+                outFile = openWriter(outputFile, fps, frame)
+            outFile.write(frame)
+        cap.release()
+
+    if outFile is not None:
+        outFile.release()
+
+#---------------------------------------------------------------------
+
+def initWorker():
+    # Each worker already has a core to itself
+    cv.setNumThreads(1)
+
+
+def convertParallel(inputFile, outputFile, workers, projection=None):
+    """Dewarp frame ranges of the input in separate processes and join the results.
+    Returns the number of frames written."""
+    cap = cv.VideoCapture(inputFile)
+    frameCount = int(cap.get(cv.CAP_PROP_FRAME_COUNT))
+    success, firstFrame = cap.read()
+    cap.release()
+
+    if firstFrame is None:
+        return 0
+
+    if frameCount < workers * 2:
+        logger.info(f"Only {frameCount} frames, converting serially")
+        return convertRange(inputFile, outputFile, projection=projection)
+
+    # Build (and cache) the plan once, so the workers just load it
+    DewarpPlan.forFrame(firstFrame, projection=projection)
+
+    ranges = splitFrames(frameCount, workers)
+    segmentDir = tempfile.mkdtemp(prefix="panorama_", dir=os.path.dirname(os.path.abspath(outputFile)))
+    extension = os.path.splitext(outputFile)[1] or ".mp4"
+    segmentFiles = [os.path.join(segmentDir, f"segment_{i:04d}{extension}") for i in range(len(ranges))]
+
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=initWorker) as executor:
+            futures = [executor.submit(convertRange, inputFile, segment, start, end, projection)
+                       for segment, (start, end) in zip(segmentFiles, ranges)]
+            counts = [future.result() for future in futures]
+
+        for (start, end), count in zip(ranges, counts):
+            if end is not None and count != end - start:
+                raise RuntimeError(f"Frames {start}-{end} of {inputFile} gave {count} frames")
+
+        joinSegments(segmentFiles, outputFile)
+    finally:
+        shutil.rmtree(segmentDir, ignore_errors=True)
+
+    return sum(counts)
+
+#---------------------------------------------------------------------
+
+class StageTimer:
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.seconds += seconds
+            self.count += 1
+
+    def report(self):
+        perFrame = self.seconds / self.count * 1000.0 if self.count else 0.0
+        return f"{self.name}: {self.count} frames, {perFrame:.2f} ms/frame"
+
+
+class PipelineStats:
+    def __init__(self):
+        self.decode = StageTimer("decode")
+        self.dewarp = StageTimer("dewarp")
+        self.encode = StageTimer("encode")
+        self.depthTotal = 0
+        self.depthSamples = 0
+        self.depthMax = 0
+        self.startTime = time.perf_counter()
+        self.endTime = None
+
+    def sampleDepth(self, depth):
+        self.depthTotal += depth
+        self.depthSamples += 1
+        self.depthMax = max(self.depthMax, depth)
+
+    def report(self):
+        elapsed = (self.endTime or time.perf_counter()) - self.startTime
+        fps = self.encode.count / elapsed if elapsed > 0 else 0.0
+        meanDepth = self.depthTotal / self.depthSamples if self.depthSamples else 0.0
+        return "; ".join([self.decode.report(), self.dewarp.report(), self.encode.report(),
+                          f"queue depth mean {meanDepth:.1f} max {self.depthMax}",
+                          f"{elapsed:.1f}s, {fps:.1f} fps"])
+
+#---------------------------------------------------------------------
+
+def putUntilStopped(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def convertPipelined(inputFile, outputFile, threads=4, queueSize=16, stats=None, projection=None):
+    """Decode, dewarp and encode concurrently: a decoder thread, a pool of dewarp
+    threads and an encoder thread that writes the frames back in order.
+    Returns the number of frames written."""
+    cap = cv.VideoCapture(inputFile)
+    if not cap.isOpened():
+        raise RuntimeError(f"Could not open {inputFile}")
+
+    fps = cap.get(cv.CAP_PROP_FPS)
+    stats = stats or PipelineStats()
+    # Futures go in in decode order, so taking them out in order keeps the frame order
+    pending = queue.Queue(maxsize=queueSize)
+    stop = threading.Event()
+    errors = []
+    written = [0]
+
+    def dewarpFrame(plan, frame):
+        start = time.perf_counter()
+        output = plan.apply(frame)
+        stats.dewarp.add(time.perf_counter() - start)
+        return output
+
+    def decode():
+        try:
+            plan = None
+            while not stop.is_set():
+                start = time.perf_counter()
+                success, frame = cap.read()
+                if frame is None:
+                    break
+                stats.decode.add(time.perf_counter() - start)
+
+                if plan is None:
+                    plan = DewarpPlan.forFrame(frame, projection=projection)
+
+                if not putUntilStopped(pending, executor.submit(dewarpFrame, plan, frame), stop):
+                    break
+                stats.sampleDepth(pending.qsize())
+            putUntilStopped(pending, None, stop)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+
+    def encode():
+        outFile = None
+        try:
+            while True:
+                try:
+                    future = pending.get(timeout=0.1)
+                except queue.Empty:
+                    if stop.is_set():
+                        break
+                    continue
+
+                if future is None:
+                    break
+
+                output = future.result()
+                start = time.perf_counter()
+                if outFile is None:
+                    outFile = openWriter(outputFile, fps, output)
+                outFile.write(output)
+                stats.encode.add(time.perf_counter() - start)
+                written[0] += 1
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            if outFile is not None:
+                outFile.release()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        decoder = threading.Thread(target=decode, name="decoder", daemon=True)
+        encoder = threading.Thread(target=encode, name="encoder", daemon=True)
+        decoder.start()
+        encoder.start()
+        decoder.join()
+        encoder.join()
+
+    cap.release()
+    stats.endTime = time.perf_counter()
+    logger.info(stats.report())
+
+    if errors:
+        raise errors[0]
+    return written[0]
+
+#---------------------------------------------------------------------
+
+def collectInputs(pattern):
+    """Video files from a directory or a glob pattern, in a stable order. Unfinished
+    outputs (.partial) are left out, in case the outputs go to the same directory."""
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, "*")
+    return sorted(f for f in glob.glob(pattern)
+                  if os.path.isfile(f) and f.lower().endswith(VIDEO_EXTENSIONS)
+                  and not os.path.splitext(f)[0].endswith(".partial"))
+
+
+class Manifest:
+    """Status of every file in a batch, kept in a JSON file next to the outputs so
+    an interrupted batch carries on from where it stopped."""
+
+    def __init__(self, path):
+        self.path = path
+        self.jobs = {}
+
+        if os.path.exists(path):
+            with open(path) as f:
+                self.jobs = json.load(f).get("jobs", {})
+
+    def save(self):
+        tmpPath = self.path + ".tmp"
+        with open(tmpPath, "w") as f:
+            json.dump({"jobs": self.jobs}, f, indent=2, sort_keys=True)
+        os.replace(tmpPath, self.path)
+
+    def isDone(self, inputFile):
+        job = self.jobs.get(inputFile)
+        return job is not None and job["status"] == "done" and os.path.exists(job["output"])
+
+    def update(self, inputFile, **fields):
+        self.jobs.setdefault(inputFile, {}).update(fields)
+        self.save()
+
+
+def convertJob(inputFile, outputFile, projection=None):
+    """Convert one whole file in a batch worker, returning (frames, seconds)."""
+    start = time.perf_counter()
+    root, extension = os.path.splitext(outputFile)
+    # Only completed conversions get the real name
+    partialFile = root + ".partial" + extension
+    frames = convertRange(inputFile, partialFile, projection=projection)
+    if frames:
+        os.replace(partialFile, outputFile)
+    return frames, time.perf_counter() - start
+
+
+def convertBatch(inputs, outputDir, workers=1, manifestFile=None, projection=None):
+    """Convert many files on one pool of worker processes. Returns the number of
+    files in the batch and the number of them that failed."""
+    os.makedirs(outputDir, exist_ok=True)
+    manifest = Manifest(manifestFile or os.path.join(outputDir, "manifest.json"))
+    failed = 0
+
+    outputs = {}
+    earlierOutputs = {job["output"] for job in manifest.jobs.values()}
+    for inputFile in inputs:
+        inputFile = os.path.abspath(inputFile)
+        # Written by an earlier run into the same directory, not an input
+        if inputFile in earlierOutputs:
+            logger.info(f"Skipping {inputFile}, output of an earlier batch")
+            continue
+        name = os.path.splitext(os.path.basename(inputFile))[0]
+        outputs[inputFile] = os.path.join(os.path.abspath(outputDir), name + ".mp4")
+
+    # Say a.mov and a.mp4, or an input that would be overwritten by its own output
+    byOutput = {}
+    for inputFile, outputFile in outputs.items():
+        byOutput.setdefault(outputFile, []).append(inputFile)
+    clashes = [f"{outputFile} from {', '.join(sources)}" for outputFile, sources in byOutput.items()
+               if len(sources) > 1 or outputFile in outputs]
+    if clashes:
+        raise ValueError("Several inputs would be written to the same output, or over an input: " +
+                         "; ".join(clashes))
+
+    jobs = {}
+    for inputFile, outputFile in outputs.items():
+        if manifest.isDone(inputFile):
+            logger.info(f"Skipping {inputFile}, already converted")
+            continue
+
+        jobs[inputFile] = outputFile
+        manifest.update(inputFile, status="pending", output=outputFile)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=initWorker) as executor:
+        futures = {}
+        for inputFile, outputFile in jobs.items():
+            futures[executor.submit(convertJob, inputFile, outputFile, projection)] = inputFile
+            manifest.update(inputFile, status="running")
+
+        for future in concurrent.futures.as_completed(futures):
+            inputFile = futures[future]
+            try:
+                frames, seconds = future.result()
+            except Exception as e:
+                logger.error(f"Failed converting {inputFile}: {e}")
+                manifest.update(inputFile, status="failed", error=str(e))
+                failed += 1
+                continue
+
+            if not frames:
+                logger.error(f"No frames read from {inputFile}")
+                manifest.update(inputFile, status="failed", error="no frames", frames=0)
+                failed += 1
+                continue
+
+            fps = frames / seconds if seconds > 0 else 0.0
+            logger.info(f"Converted {inputFile}: {frames} frames, {fps:.1f} fps")
+            manifest.update(inputFile, status="done", frames=frames, seconds=round(seconds, 3),
+                            fps=round(fps, 2), error=None)
+
+    return len(outputs), failed
+
+#---------------------------------------------------------------------
+
+def convertFile(inputFile, outputFile, workers=1, threads=0, projection=None):
+    if workers > 1:
+        return convertParallel(inputFile, outputFile, workers, projection=projection)
+    if threads > 0:
+        return convertPipelined(inputFile, outputFile, threads, projection=projection)
+    return convertRange(inputFile, outputFile, projection=projection)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#cython: language_level=3, boundscheck=False
+###############################################################################
+#
+# Post-processing of the matcher output, each step timed and switchable so
+# the best quality that fits the frame budget can be picked.
+#
+# consistency  left-right check, drops pixels where matching right to left
+#              does not agree (costs a second match)
+# speckle      removes small blobs that differ from their surroundings
+# smoothing    edge-aware fill and smoothing, guided by the left image
+#              (a guided filter weighted by confidence, in the spirit of the
+#              WLS filter from opencv-contrib, with plain OpenCV only)
+#
+###############################################################################
+import time
+
+import cv2
+import numpy as np
+
+from disparity import MatcherPool
+
+POSTFILTER_STEPS = ("consistency", "speckle", "smoothing")
+
+#---------------------------------------------------------------------
+
+class PostFilter:
+    def __init__(self, parameters, create=cv2.StereoBM_create, steps=(), tolerance=1.0, speckleSize=200,
+                 speckleRange=2.0, radius=4, epsilon=1e-3):
+        self.parameters = parameters
+        self.matchers = MatcherPool(create)
+        self.steps = set()
+        for step in steps:
+            self.enable(step)
+
+        # Pixels, as disparities
+        self.tolerance = tolerance
+        self.speckleSize = speckleSize
+        self.speckleRange = speckleRange
+        # Guided filter window radius and regularisation (for guide values 0..1)
+        self.radius = radius
+        self.epsilon = epsilon
+
+        self.buffers = {}
+        self.timings = {}
+        self.columns = None
+
+    def enable(self, step, enabled=True):
+        if step not in POSTFILTER_STEPS:
+            raise ValueError(f"Unknown post-filter step {step}, expected one of {', '.join(POSTFILTER_STEPS)}")
+        if enabled:
+            self.steps.add(step)
+        else:
+            self.steps.discard(step)
+
+    def buffer(self, name, shape, dtype):
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = self.buffers[name] = np.empty(shape, dtype)
+        return buffer
+
+    def time(self, step, start):
+        milliseconds = (time.perf_counter() - start) * 1000.0
+        count, total, _ = self.timings.get(step, (0, 0.0, 0.0))
+        self.timings[step] = (count + 1, total + milliseconds, milliseconds)
+
+    def range(self):
+        matcher = self.matchers.get(self.parameters)
+        return matcher.getMinDisparity(), matcher.getNumDisparities()
+
+    #---------------------------------------------------------------------
+
+    def apply(self, disparity, left, right):
+        """Filter a disparity map (16-bit fixed point) of the rectified gray pair.
+        Returns disparity itself when no step is on, else a reused buffer."""
+        if not self.steps:
+            return disparity
+
+        minDisparity, numDisparities = self.range()
+        invalid = (minDisparity - 1) * 16
+        filtered = self.buffer("filtered", disparity.shape, np.int16)
+        np.copyto(filtered, disparity)
+
+        if "consistency" in self.steps:
+            start = time.perf_counter()
+            self.checkConsistency(filtered, left, right, invalid)
+            self.time("consistency", start)
+
+        if "speckle" in self.steps:
+            start = time.perf_counter()
+            cv2.filterSpeckles(filtered, invalid, self.speckleSize, int(self.speckleRange * 16))
+            self.time("speckle", start)
+
+        if "smoothing" in self.steps:
+            start = time.perf_counter()
+            self.smooth(filtered, left, invalid)
+            self.time("smoothing", start)
+
+        return filtered
+
+    def checkConsistency(self, disparity, left, right, invalid):
+        # Disparity of the right image: match the mirrored pair the other way round
+        matcher = self.matchers.get(self.parameters)
+        rightDisparity = cv2.flip(matcher.compute(cv2.flip(right, 1), cv2.flip(left, 1)), 1)
+
+        height, width = disparity.shape
+        if self.columns is None or self.columns.shape != (height, width):
+            self.columns = np.broadcast_to(np.arange(width, dtype=np.int32), (height, width))
+            self.rows = np.broadcast_to(np.arange(height, dtype=np.int32)[:, None], (height, width))
+
+        # Where each left pixel lands in the right image
+        target = self.buffer("target", (height, width), np.int32)
+        np.subtract(self.columns, (disparity.astype(np.int32) + 8) >> 4, out=target)
+        np.clip(target, 0, width - 1, out=target)
+
+        # Only where the right image has a match to compare with: its right edge never does,
+        # mirrored it is the left edge a matcher skips
+        matched = rightDisparity[self.rows, target]
+        difference = np.abs(disparity.astype(np.int32) - matched)
+        disparity[(difference > self.tolerance * 16) & (matched > invalid)] = invalid
+
+    def smooth(self, disparity, left, invalid):
+        # Guided filter of disparity * confidence and of confidence, so unmatched
+        # pixels do not pull their neighbours down and small holes get filled
+        size = (2 * self.radius + 1, 2 * self.radius + 1)
+
+        def box(image):
+            return cv2.boxFilter(image, cv2.CV_32F, size, borderType=cv2.BORDER_REFLECT)
+
+        guide = left.astype(np.float32) * (1.0 / 255.0)
+        confidence = (disparity > invalid).astype(np.float32)
+        values = disparity.astype(np.float32) * confidence
+
+        meanGuide = box(guide)
+        varianceGuide = box(guide * guide) - meanGuide * meanGuide + self.epsilon
+
+        def guidedFilter(p):
+            meanP = box(p)
+            a = (box(guide * p) - meanGuide * meanP) / varianceGuide
+            b = meanP - a * meanGuide
+            return box(a) * guide + box(b)
+
+        weight = guidedFilter(confidence)
+        smoothed = guidedFilter(values)
+        valid = weight > 0.25
+        disparity[valid] = np.rint(smoothed[valid] / weight[valid]).astype(np.int16)
+        disparity[~valid] = invalid
+
+    #---------------------------------------------------------------------
+
+    def report(self):
+        return ", ".join(f"{step} {total / count:.1f} ms (last {last:.1f})"
+                         for step, (count, total, last) in self.timings.items())
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#cython: language_level=3, boundscheck=False
+###############################################################################
+#
+# Panorama projections for 360 degree (fisheye) frames.
+#
+# Every projection here is separable around the lens center: an output
+# column gives the azimuth and an output row gives the distance from the
+# center, so each one only describes those two mappings and the remap
+# tables are built from them once per video (see dewarp.py).
+#
+# A projection can also be limited to a window (azimuth range and radius
+# range) and scaled down for previews. The tables then only cover the
+# requested output pixels, so the per-frame cost shrinks with them.
+#
+###############################################################################
+import abc
+import math
+
+import numpy as np
+
+#---------------------------------------------------------------------
+
+class Projection(abc.ABC):
+    name = None
+
+    def __init__(self, center=None, radius=None, outputSize=None, scale=1.0, azimuthRange=None, radiusRange=None):
+        # center is (x, y) in pixels, outputSize is (width, height)
+        self.center = center
+        self.radius = radius
+        self.outputSize = outputSize
+        self.scale = scale
+        # azimuthRange is (start, end) in radians, radiusRange is (inner, outer)
+        # as fractions of the radius
+        self.azimuthRange = (0.0, 2 * math.pi)
+        if azimuthRange is not None:
+            start, end = (float(a) for a in azimuthRange)
+            # A sector through 0, say 300 to 60 degrees
+            if end < start:
+                end += 2 * math.pi
+            if not 0 < end - start <= 2 * math.pi + 1e-9:
+                raise ValueError(f"Azimuth range {tuple(azimuthRange)} is empty or more than a full turn")
+            self.azimuthRange = (start, end)
+
+        self.radiusRange = (0.0, 1.0)
+        if radiusRange is not None:
+            inner, outer = (float(r) for r in radiusRange)
+            if not 0 <= inner < outer <= 1:
+                raise ValueError(f"Radius range {tuple(radiusRange)} must have 0 <= inner < outer <= 1")
+            self.radiusRange = (inner, outer)
+
+    def resolve(self, inputSize):
+        """Center, radius and output size for frames of this (width, height)."""
+        width, height = inputSize
+        center = self.center if self.center is not None else (width / 2.0, height / 2.0)
+        # Same default radius as the original warpPolar call
+        radius = self.radius if self.radius is not None else max(width, height) / 2.0
+
+        if self.outputSize is not None:
+            outWidth, outHeight = self.outputSize
+        else:
+            # Full panorama size, cut down to the window
+            outWidth, outHeight = self.defaultOutputSize(radius)
+            rowStart, rowEnd = self.rowRange(radius)
+            outWidth *= (self.azimuthRange[1] - self.azimuthRange[0]) / (2 * math.pi)
+            outHeight *= rowEnd - rowStart
+
+        outputSize = (max(1, int(round(outWidth * self.scale))), max(1, int(round(outHeight * self.scale))))
+        return (float(center[0]), float(center[1])), float(radius), outputSize
+
+    def defaultOutputSize(self, radius):
+        # Same as warpPolar with dsize (-1, -1), rotated
+        return int(round(radius * math.pi)), int(round(radius))
+
+    def parameters(self):
+        return ()
+
+    def key(self, inputSize):
+        return f"{self.name}:{self.resolve(inputSize)}:{self.azimuthRange}:{self.radiusRange}:{self.parameters()}"
+
+    #---------------------------------------------------------------------
+
+    @abc.abstractmethod
+    def rowRadius(self, v, radius):
+        """Distance from the center for normalized rows v, 0 at the top of the full panorama and 1 at the bottom."""
+
+    def rowRange(self, radius):
+        """Normalized rows covering the radius range (rowRadius always grows down the panorama)."""
+        if self.radiusRange == (0.0, 1.0):
+            return 0.0, 1.0
+
+        v = np.linspace(0.0, 1.0, 4097)
+        rho = self.rowRadius(v, radius)
+        inner, outer = self.radiusRange
+        return tuple(float(x) for x in np.interp([inner * radius, outer * radius], rho, v))
+
+    def maps(self, inputSize):
+        """Float source maps (mapX, mapY) for cv.remap."""
+        center, radius, (outWidth, outHeight) = self.resolve(inputSize)
+        rowStart, rowEnd = self.rowRange(radius)
+        azimuthStart, azimuthEnd = self.azimuthRange
+
+        v = rowStart + np.arange(outHeight, dtype=np.float64) * ((rowEnd - rowStart) / outHeight)
+        # Radius and center rounded to float first, as warpPolar does, so samples that fall
+        # exactly between two pixels (a half-pixel center, odd frame sizes) round the same way
+        rho = self.rowRadius(v, radius).astype(np.float32).astype(np.float64)
+        centerX, centerY = (float(np.float32(value)) for value in center)
+        # Angle runs backwards along the row, as in the rotated warpPolar output
+        phi = azimuthStart + np.arange(outWidth - 1, -1, -1, dtype=np.float64) * ((azimuthEnd - azimuthStart) / outWidth)
+
+        mapX = (centerX + rho[:, None] * np.cos(phi)[None, :]).astype(np.float32)
+        mapY = (centerY + rho[:, None] * np.sin(phi)[None, :]).astype(np.float32)
+        return mapX, mapY
+
+#---------------------------------------------------------------------
+
+class LinearPolar(Projection):
+    name = "polar"
+
+    def rowRadius(self, v, radius):
+        return v * radius
+
+
+class LogPolar(Projection):
+    name = "logpolar"
+
+    def rowRadius(self, v, radius):
+        # Same spacing as WARP_POLAR_LOG
+        return np.exp(v * math.log(radius))
+
+#---------------------------------------------------------------------
+
+class FisheyeProjection(Projection):
+    """Projections that need the lens model: equidistant fisheye with the
+    optical axis at the center and fov covering the whole image circle."""
+
+    def __init__(self, fov=math.radians(235), **kwargs):
+        Projection.__init__(self, **kwargs)
+        self.fov = fov
+
+    def parameters(self):
+        return (self.fov,)
+
+    def radiusForAngle(self, theta, radius):
+        # theta is the angle from the optical axis
+        return theta * (radius / (self.fov / 2.0))
+
+
+class Equirectangular(FisheyeProjection):
+    name = "equirectangular"
+
+    def defaultOutputSize(self, radius):
+        width = int(round(radius * math.pi))
+        # Square pixels in angle: 360 degrees across, fov / 2 down
+        return width, int(round(width * (self.fov / 2.0) / (2 * math.pi)))
+
+    def rowRadius(self, v, radius):
+        # Top row is the zenith, bottom row the edge of the image circle
+        return self.radiusForAngle(v * (self.fov / 2.0), radius)
+
+
+class Cylindrical(FisheyeProjection):
+    name = "cylindrical"
+
+    def __init__(self, maxElevation=math.radians(60), **kwargs):
+        FisheyeProjection.__init__(self, **kwargs)
+        # A cylinder cannot reach the zenith, so it is cut off here
+        self.maxElevation = maxElevation
+
+    def parameters(self):
+        return (self.fov, self.maxElevation)
+
+    def heightRange(self):
+        minElevation = math.pi / 2.0 - self.fov / 2.0
+        return math.tan(self.maxElevation), math.tan(minElevation)
+
+    def defaultOutputSize(self, radius):
+        width = int(round(radius * math.pi))
+        top, bottom = self.heightRange()
+        return width, int(round(width * (top - bottom) / (2 * math.pi)))
+
+    def rowRadius(self, v, radius):
+        top, bottom = self.heightRange()
+        elevation = np.arctan(top - v * (top - bottom))
+        return self.radiusForAngle(math.pi / 2.0 - elevation, radius)
+
+#---------------------------------------------------------------------
+
+PROJECTIONS = {projection.name: projection for projection in (LinearPolar, LogPolar, Equirectangular, Cylindrical)}
+
+
+def createProjection(name, fov=None, **kwargs):
+    if name not in PROJECTIONS:
+        raise ValueError(f"Unknown projection {name}, expected one of {', '.join(PROJECTIONS)}")
+
+    projectionClass = PROJECTIONS[name]
+    if fov is not None and issubclass(projectionClass, FisheyeProjection):
+        kwargs["fov"] = fov
+    return projectionClass(**kwargs)
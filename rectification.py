@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#cython: language_level=3, boundscheck=False
+###############################################################################
+#
+# Stereo rectification with cached maps and selectable interpolation.
+#
+# The disparity matchers only need grayscale, so the gray images are
+# remapped directly (a third of the work of a BGR remap) and the color
+# images only when a color view is actually shown.
+#
+###############################################################################
+import time
+
+import cv2
+import numpy as np
+
+# From fastest to best looking
+INTERPOLATION_TIERS = {
+    "nearest": cv2.INTER_NEAREST,
+    "linear": cv2.INTER_LINEAR,
+    "lanczos": cv2.INTER_LANCZOS4,
+}
+
+#---------------------------------------------------------------------
+
+def fixedPointMap(stereoMap):
+    """(map1, map2) from initUndistortRectifyMap or a saved file, as CV_16SC2 + CV_16UC1."""
+    map1, map2 = stereoMap
+    if map1.dtype == np.float32:
+        map1, map2 = cv2.convertMaps(map1, map2, cv2.CV_16SC2)
+    return map1, map2
+
+#---------------------------------------------------------------------
+
+class Rectifier:
+    def __init__(self, leftStereoMap, rightStereoMap, tier="linear"):
+        self.leftMap = fixedPointMap(leftStereoMap)
+        self.rightMap = fixedPointMap(rightStereoMap)
+        self.setTier(tier)
+
+        # Output buffers, reused while the frame size stays the same
+        self.buffers = {}
+
+    def setTier(self, tier):
+        if tier not in INTERPOLATION_TIERS:
+            raise ValueError(f"Unknown interpolation {tier}, expected one of {', '.join(INTERPOLATION_TIERS)}")
+        self.tier = tier
+        self.interpolation = INTERPOLATION_TIERS[tier]
+
+    def buffer(self, name, shape):
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != shape:
+            buffer = self.buffers[name] = np.empty(shape, np.uint8)
+        return buffer
+
+    def remap(self, image, stereoMap, name, interpolation=None):
+        # Nearest only needs the integer part of the map
+        interpolation = self.interpolation if interpolation is None else interpolation
+        map2 = None if interpolation == cv2.INTER_NEAREST else stereoMap[1]
+        out = self.buffer(name, stereoMap[0].shape[:2] + image.shape[2:])
+        return cv2.remap(image, stereoMap[0], map2, interpolation, dst=out,
+                         borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+    #---------------------------------------------------------------------
+
+    def rectify(self, leftImage, rightImage, color=False, grayLeft=None, grayRight=None):
+        """Rectify a BGR pair. Returns (grayLeft, grayRight, colorLeft, colorRight), the color
+        images None unless asked for. Gray inputs can be passed in if they are already known.
+        The results are reused buffers, valid until the next call."""
+        if color:
+            colorLeft = self.remap(leftImage, self.leftMap, "colorLeft")
+            colorRight = self.remap(rightImage, self.rightMap, "colorRight")
+            rectifiedGrayLeft = cv2.cvtColor(colorLeft, cv2.COLOR_BGR2GRAY,
+                                             dst=self.buffer("grayLeft", colorLeft.shape[:2]))
+            rectifiedGrayRight = cv2.cvtColor(colorRight, cv2.COLOR_BGR2GRAY,
+                                              dst=self.buffer("grayRight", colorRight.shape[:2]))
+            return rectifiedGrayLeft, rectifiedGrayRight, colorLeft, colorRight
+
+        if grayLeft is None:
+            grayLeft = cv2.cvtColor(leftImage, cv2.COLOR_BGR2GRAY)
+        if grayRight is None:
+            grayRight = cv2.cvtColor(rightImage, cv2.COLOR_BGR2GRAY)
+
+        return (self.remap(grayLeft, self.leftMap, "grayLeft"),
+                self.remap(grayRight, self.rightMap, "grayRight"), None, None)
+
+    #---------------------------------------------------------------------
+
+    def benchmark(self, leftImage, rightImage, repeats=20):
+        """Milliseconds per frame pair for each tier, gray only and with color."""
+        grayLeft = cv2.cvtColor(leftImage, cv2.COLOR_BGR2GRAY)
+        grayRight = cv2.cvtColor(rightImage, cv2.COLOR_BGR2GRAY)
+        results = {}
+        savedTier = self.tier
+
+        try:
+            for tier in INTERPOLATION_TIERS:
+                self.setTier(tier)
+                for color in (False, True):
+                    start = time.perf_counter()
+                    for _ in range(repeats):
+                        self.rectify(leftImage, rightImage, color, grayLeft, grayRight)
+                    results[(tier, "color" if color else "gray")] = (time.perf_counter() - start) / repeats * 1000.0
+        finally:
+            self.setTier(savedTier)
+
+        return results
+
+
+def formatBenchmark(results):
+    return "\n".join(f"{tier:8s} {mode:5s} {ms:7.2f} ms/frame" for (tier, mode), ms in results.items())
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#cython: language_level=3, boundscheck=False
+###############################################################################
+#
+# Camera calibration solved in a worker process, so the GUI and the live
+# view keep running while it takes its time.
+#
+# The solve works on a snapshot of the collected points and reports its
+# progress. It can be cancelled at any point, OpenCV calls included, since
+# cancelling ends the process. The result is a dict of the calibration
+# attributes the GUIs keep, maps included, handed over in one piece.
+#
+# Stereo calibration is incremental: the views go into an IncrementalCalibrator
+# that is solved again as pictures are added, starting from the previous
+# intrinsics and dropping views that do not fit.
+#
+###############################################################################
+import multiprocessing
+import queue
+import threading
+
+import cv2
+import numpy as np
+
+from coefficients import StereoCalibration
+
+#---------------------------------------------------------------------
+
+def rotationMatrices(rvecs):
+    """Rodrigues vectors (V x 3) to rotation matrices (V x 3 x 3), all at once."""
+    rvecs = np.asarray(rvecs, np.float64).reshape(-1, 3)
+    theta = np.linalg.norm(rvecs, axis=1)
+    axis = rvecs / np.where(theta > 1e-12, theta, 1.0)[:, None]
+    x, y, z = axis.T
+    zero = np.zeros_like(x)
+    K = np.stack([zero, -z, y, z, zero, -x, -y, x, zero], axis=1).reshape(-1, 3, 3)
+    sin, cos = np.sin(theta)[:, None, None], np.cos(theta)[:, None, None]
+    return np.eye(3) + sin * K + (1 - cos) * (K @ K)
+
+
+def viewErrors(objpoints, imgpoints, rvecs, tvecs, cameraMatrix, distCoeffs):
+    """RMS reprojection error of each view, in pixels. The views are moved into the
+    camera frame together and projected with one projectPoints call."""
+    counts = np.array([len(points.reshape(-1, 3)) for points in objpoints])
+    objectPoints = np.concatenate([points.reshape(-1, 3) for points in objpoints]).astype(np.float64)
+    imagePoints = np.concatenate([points.reshape(-1, 2) for points in imgpoints]).astype(np.float64)
+
+    rotations = np.repeat(rotationMatrices(rvecs), counts, axis=0)
+    translations = np.repeat(np.asarray(tvecs, np.float64).reshape(-1, 3), counts, axis=0)
+    cameraPoints = np.einsum("nij,nj->ni", rotations, objectPoints) + translations
+
+    projected, _ = cv2.projectPoints(cameraPoints.reshape(-1, 1, 3), np.zeros(3), np.zeros(3),
+                                     cameraMatrix, distCoeffs)
+    squared = ((projected.reshape(-1, 2) - imagePoints) ** 2).sum(axis=1)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    return np.sqrt(np.add.reduceat(squared, starts) / counts)
+
+
+class IncrementalCalibrator:
+    """Intrinsics of one or more cameras that see the same views, solved again as
+    views are added.
+
+    Each solve starts from the previous intrinsics (CALIB_USE_INTRINSIC_GUESS),
+    so it converges in a few iterations. After a solve the reprojection error of
+    every view is checked, and the worst view is dropped while it is above both
+    minError and outlierFactor times the median, then the rest is solved again.
+    A view counts with its worst camera. converged() tells when the intrinsics
+    stopped moving for a few solves, so capturing more pictures no longer helps."""
+
+    MIN_VIEWS = 4
+    # Stops once the parameters change by less than 1e-6, instead of always running all iterations
+    CRITERIA = (cv2.TERM_CRITERIA_COUNT + cv2.TERM_CRITERIA_EPS, 30, 1e-6)
+
+    def __init__(self, imageSize, cameras=1, minViews=MIN_VIEWS, outlierFactor=2.5, minError=0.5, tolerance=0.002,
+                 settle=3):
+        self.imageSize = imageSize
+        self.cameras = cameras
+        self.minViews = minViews
+        self.outlierFactor = outlierFactor
+        self.minError = minError
+        # Relative move of the intrinsics, and how many solves in a row must stay below it
+        self.tolerance = tolerance
+        self.settle = settle
+
+        self.objpoints = []
+        self.imgpoints = [[] for _ in range(cameras)]
+        self.rejected = set()
+        self.cameraMatrix = [None] * cameras
+        self.distCoeffs = [None] * cameras
+        self.rvecs = [None] * cameras
+        self.tvecs = [None] * cameras
+        self.rms = [None] * cameras
+        # Per kept view, worst camera
+        self.errors = None
+        self.change = None
+        self.stable = 0
+
+    def add(self, objp, *corners):
+        """Add a view, with the corners of each camera."""
+        if len(corners) != self.cameras:
+            raise ValueError(f"Expected corners of {self.cameras} cameras, got {len(corners)}")
+        self.objpoints.append(objp)
+        for camera, points in enumerate(corners):
+            self.imgpoints[camera].append(points)
+
+    def viewCount(self):
+        """Views added, the rejected ones included."""
+        return len(self.objpoints)
+
+    def keptViews(self):
+        return [view for view in range(len(self.objpoints)) if view not in self.rejected]
+
+    def points(self, views=None):
+        """(objpoints, imgpoints of each camera) of the kept views."""
+        views = self.keptViews() if views is None else views
+        return ([self.objpoints[view] for view in views],
+                [[imgpoints[view] for view in views] for imgpoints in self.imgpoints])
+
+    def solveCamera(self, camera, objpoints, imgpoints):
+        if self.cameraMatrix[camera] is None:
+            return cv2.calibrateCamera(objpoints, imgpoints, self.imageSize, None, None, criteria=self.CRITERIA)
+        return cv2.calibrateCamera(objpoints, imgpoints, self.imageSize, self.cameraMatrix[camera].copy(),
+                                   self.distCoeffs[camera].copy(), flags=cv2.CALIB_USE_INTRINSIC_GUESS,
+                                   criteria=self.CRITERIA)
+
+    def solve(self):
+        """Solve over the kept views and drop outliers. Returns the list of views dropped."""
+        if not self.keptViews():
+            raise RuntimeError("No views to calibrate with")
+
+        previous = [matrix.copy() if matrix is not None else None for matrix in self.cameraMatrix]
+        dropped = []
+        while True:
+            views = self.keptViews()
+            objpoints, imgpoints = self.points(views)
+            errors = np.zeros(len(views))
+            for camera in range(self.cameras):
+                self.rms[camera], self.cameraMatrix[camera], self.distCoeffs[camera], \
+                self.rvecs[camera], self.tvecs[camera] = self.solveCamera(camera, objpoints, imgpoints[camera])
+                np.maximum(errors, viewErrors(objpoints, imgpoints[camera], self.rvecs[camera], self.tvecs[camera],
+                                              self.cameraMatrix[camera], self.distCoeffs[camera]), out=errors)
+            self.errors = errors
+
+            worst = int(np.argmax(errors))
+            limit = max(self.minError, self.outlierFactor * np.median(errors))
+            if len(views) <= self.minViews or errors[worst] <= limit:
+                break
+            self.rejected.add(views[worst])
+            dropped.append(views[worst])
+
+        # Largest relative move of the focal lengths and the principal point
+        if previous[0] is not None:
+            self.change = max(np.abs(self.cameraMatrix[camera][[0, 1, 0, 1], [0, 1, 2, 2]] /
+                                     previous[camera][[0, 1, 0, 1], [0, 1, 2, 2]] - 1).max()
+                              for camera in range(self.cameras))
+            self.stable = self.stable + 1 if self.change < self.tolerance else 0
+        return dropped
+
+    def converged(self):
+        return self.stable >= self.settle
+
+    def report(self):
+        rms = ", ".join(f"{value:.3f}" for value in self.rms if value is not None)
+        change = f", intrinsics moved {self.change * 100:.2f}%" if self.change is not None else ""
+        return (f"{len(self.keptViews())} of {len(self.objpoints)} views, RMS {rms} px, "
+                f"worst view {self.errors.max():.3f} px{change}")
+
+#---------------------------------------------------------------------
+
+def solveMono(objpoints, imgpoints, imageSize, progress):
+    """Intrinsics of one camera. imageSize is (width, height)."""
+    progress(0, 1, "Calibrating camera")
+    retval, cameraMatrix, distCoeffs, rvecs, tvecs = cv2.calibrateCamera(objpoints, imgpoints, imageSize,
+                                                                         None, None)
+    newCameraMatrix, roi = cv2.getOptimalNewCameraMatrix(cameraMatrix, distCoeffs, imageSize, 1, imageSize)
+
+    return {"cameraMatrixLeft": cameraMatrix, "distCoeffsLeft": distCoeffs, "rvecsLeft": rvecs,
+            "tvecsLeft": tvecs, "newCameraMatrixLeft": newCameraMatrix, "roiLeft": roi}
+
+
+def solveStereo(calibrator, progress):
+    """Intrinsics of both cameras, their relative pose, the rectification and its maps.
+    calibrator is a two camera IncrementalCalibrator holding the views. It comes back
+    in the result, solved, for the next solve to start from, with the views this
+    solve dropped as droppedViews."""
+    steps = 4
+    imageSize = calibrator.imageSize
+    progress(0, steps, "Calibrating cameras")
+    droppedViews = calibrator.solve()
+    objpoints, (imgpointsLeft, imgpointsRight) = calibrator.points()
+
+    result = {"calibrator": calibrator, "droppedViews": droppedViews}
+    for camera, side in enumerate(("Left", "Right")):
+        cameraMatrix, distCoeffs = calibrator.cameraMatrix[camera], calibrator.distCoeffs[camera]
+        newCameraMatrix, roi = cv2.getOptimalNewCameraMatrix(cameraMatrix, distCoeffs, imageSize, 1, imageSize)
+        result.update({"cameraMatrix" + side: cameraMatrix, "rvecs" + side: calibrator.rvecs[camera],
+                       "tvecs" + side: calibrator.tvecs[camera], "newCameraMatrix" + side: newCameraMatrix,
+                       "distCoeffs" + side: distCoeffs, "roi" + side: roi})
+
+    progress(1, steps, "Calibrating stereo pair")
+    flags = 0
+    flags |= cv2.CALIB_FIX_INTRINSIC
+    criteria_stereo = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+
+    retStereo, newCameraMatrixLeft, distCoeffsLeft, newCameraMatrixRight, distCoeffsRight, \
+    rotation, translation, essential, fundamental = cv2.stereoCalibrate(
+                        objpoints, imgpointsLeft, imgpointsRight,
+                        result["newCameraMatrixLeft"], result["distCoeffsLeft"],
+                        result["newCameraMatrixRight"], result["distCoeffsRight"],
+                        imageSize, criteria_stereo, flags)
+
+    progress(2, steps, "Rectifying")
+    rectify_scale = 1
+    leftRectification, rightRectification, projectionMatrixLeft, projectionMatrixRight, \
+    Qmatrix, leftROI, rightROI = cv2.stereoRectify(
+                        newCameraMatrixLeft, distCoeffsLeft, newCameraMatrixRight, distCoeffsRight,
+                        imageSize, rotation, translation, rectify_scale, (0, 0))
+
+    result.update({"newCameraMatrixLeft": newCameraMatrixLeft, "distCoeffsLeft": distCoeffsLeft,
+                   "newCameraMatrixRight": newCameraMatrixRight, "distCoeffsRight": distCoeffsRight,
+                   "rotation": rotation, "translation": translation, "essential": essential,
+                   "fundamental": fundamental, "leftRectification": leftRectification,
+                   "rightRectification": rightRectification, "projectionMatrixLeft": projectionMatrixLeft,
+                   "projectionMatrixRight": projectionMatrixRight, "Qmatrix": Qmatrix, "leftROI": leftROI,
+                   "rightROI": rightROI})
+
+    # What is saved, the maps are made from it
+    progress(3, steps, "Computing rectification maps")
+    result["stereoCalibration"] = StereoCalibration.fromSolve(result, imageSize)
+    result["leftStereoMap"], result["rightStereoMap"] = result["stereoCalibration"].maps()
+    return result
+
+#---------------------------------------------------------------------
+
+def runSolver(messages, solve, args):
+    def progress(step, steps, message):
+        messages.put(("progress", (step, steps, message)))
+
+    try:
+        messages.put(("done", solve(*args, progress=progress)))
+    except Exception as exception:
+        messages.put(("failed", str(exception)))
+
+
+class CalibrationSolver:
+    """Runs one solve function at a time in a worker process.
+
+    The callbacks are called from a monitor thread: onProgress(step, steps,
+    message) as the solve goes on, then either onDone(result) or
+    onFailed(message), a cancel included."""
+
+    def __init__(self):
+        # Forking a process with GUI and camera threads is not safe
+        self.context = multiprocessing.get_context("spawn")
+        self.process = None
+        self.cancelled = None
+
+    def running(self):
+        return self.process is not None and self.process.is_alive()
+
+    def start(self, solve, args, onProgress, onDone, onFailed):
+        if self.running():
+            raise RuntimeError("A calibration is already running")
+
+        messages = self.context.Queue()
+        self.process = self.context.Process(target=runSolver, args=(messages, solve, args), daemon=True)
+        self.cancelled = threading.Event()
+        self.process.start()
+
+        monitor = threading.Thread(target=self.monitor, daemon=True,
+                                   args=(self.process, messages, self.cancelled, onProgress, onDone, onFailed))
+        monitor.start()
+
+    def cancel(self):
+        if self.running():
+            self.cancelled.set()
+            self.process.terminate()
+
+    def monitor(self, process, messages, cancelled, onProgress, onDone, onFailed):
+        while True:
+            try:
+                kind, value = messages.get(timeout=0.2)
+            except queue.Empty:
+                if process.is_alive():
+                    continue
+                # The last message can arrive just as the process ends
+                try:
+                    kind, value = messages.get(timeout=0.2)
+                except queue.Empty:
+                    kind, value = "failed", f"Calibration process ended with code {process.exitcode}"
+
+            if cancelled.is_set():
+                kind, value = "failed", "Calibration cancelled"
+            if kind == "progress":
+                onProgress(*value)
+                continue
+
+            process.join()
+            if kind == "done":
+                onDone(value)
+            else:
+                onFailed(value)
+            return
@@ -5,6 +5,7 @@
 # are fixed in place relative to each other, and as parallel as possible.
 #
 #######################################################################
+import argparse
 import glob
 import os
 
@@ -13,11 +14,55 @@ import numpy as np
 import sys
 import wx
 
-if len(sys.argv) < 3:
-    print("Usage: stereo_film.py  <calibrationFile>  <left input device> <right input device>")
-    print("If no devices are given, existing files will be used")
-    print("Too few command line arguments\n")
-    sys.exit(2)
+from capture import StereoCapture
+from coefficients import StereoCalibration, isBundle, loadXmlMaps
+from colormap import DisparityRenderer
+from depth import CLOUD_FORMATS, CloudWriter, DepthStage
+from postfilter import POSTFILTER_STEPS, PostFilter
+from disparity import (MATCHING_MODES, MatcherPool, PyramidDisparityEngine, StereoParameters, StripDisparityEngine,
+                       TemporalDisparityEngine, formatComparison)
+from rectification import INTERPOLATION_TIERS, Rectifier, formatBenchmark
+
+# Views that can be shown. Only what the chosen views need is computed each frame.
+VIEWS = ["raw", "unrectified-anaglyph", "rectified", "anaglyph", "disparity", "unrectified-disparity"]
+
+
+def positiveInt(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
+
+parser = argparse.ArgumentParser(description="Show rectified stereo video and its disparity map")
+parser.add_argument("calibrationFile", help="Calibration file, or an older XML file with the stereo maps")
+parser.add_argument("leftDevice", help="Left input device or file")
+parser.add_argument("rightDevice", help="Right input device or file")
+parser.add_argument("--views", default="anaglyph,disparity",
+                    help=f"Comma separated views to show, from: {', '.join(VIEWS)}")
+parser.add_argument("--bands", type=positiveInt,
+                    help="Horizontal bands the rectified disparity is matched in, in parallel "
+                         "(default: one per usable core)")
+parser.add_argument("--temporal", action="store_true",
+                    help="Only match the tiles that changed since the last frame, for static scenes")
+parser.add_argument("--postfilter", default="",
+                    help=f"Comma separated post-filter steps for the disparity, from: {', '.join(POSTFILTER_STEPS)}")
+parser.add_argument("--square-size", type=float, default=1.0,
+                    help="Chessboard square size, the unit of depth (e.g. in mm). Depth is in squares by default")
+parser.add_argument("--cloud", help="Directory to write a point cloud per frame to")
+parser.add_argument("--cloud-format", choices=CLOUD_FORMATS, default="ply", help="Point cloud file format")
+parser.add_argument("--voxel", type=float, help="Merge points closer than this, in depth units, to keep clouds small")
+args = parser.parse_args()
+
+views = set(args.views.split(","))
+if not views <= set(VIEWS):
+    parser.error(f"Unknown views: {', '.join(sorted(views - set(VIEWS)))}")
+postFilterSteps = set(filter(None, args.postfilter.split(",")))
+if not postFilterSteps <= set(POSTFILTER_STEPS):
+    parser.error(f"Unknown post-filter steps: {', '.join(sorted(postFilterSteps - set(POSTFILTER_STEPS)))}")
+
+needColor = bool(views & {"rectified", "anaglyph"}) or args.cloud is not None
+needRectifiedGray = "disparity" in views or args.cloud is not None
 
 
 print("OpenCV version", cv2.__version__)
@@ -28,20 +73,43 @@ def nothing(x):
     pass
 
 
+def anaglyph(left, right):
+    # Blue and green from the left image, red from the right
+    out = left.copy()
+    out[:,:,2] = right[:,:,2]
+    return out
+
+
+disp = None
+depthStage = None
+
 def mouseCallback(event, x, y, flags, userdata):
-    if event == cv2.EVENT_LBUTTONDOWN:
+    if event == cv2.EVENT_LBUTTONDOWN and disp is not None:
         disparity = disp[y, x]
-        print(f"Disparity {disparity} ({x},{y})")
-        inverse = 1.0 / disparity
+        depth = depthStage.depthAt(disparity) if depthStage is not None else None
+        print(f"Disparity {disparity / 16.0:.2f} ({x},{y})" + (f" depth {depth:.1f}" if depth is not None else ""))
 
 
 # Reading the mapping values for stereo image rectification
-cv_file = cv2.FileStorage(sys.argv[1], cv2.FILE_STORAGE_READ)
-Left_Stereo_Map_x = cv_file.getNode("Left_Stereo_Map_x").mat()
-Left_Stereo_Map_y = cv_file.getNode("Left_Stereo_Map_y").mat()
-Right_Stereo_Map_x = cv_file.getNode("Right_Stereo_Map_x").mat()
-Right_Stereo_Map_y = cv_file.getNode("Right_Stereo_Map_y").mat()
-cv_file.release()
+if isBundle(args.calibrationFile):
+    try:
+        calibration = StereoCalibration.load(args.calibrationFile)
+    except (OSError, ValueError) as exception:
+        parser.error(str(exception))
+    # Memory-mapped from the cache next to the file after the first run
+    leftStereoMap, rightStereoMap = calibration.maps()
+    Q = calibration.Q
+else:
+    leftStereoMap, rightStereoMap, Q = loadXmlMaps(args.calibrationFile)
+
+if Q is not None:
+    depthStage = DepthStage(Q, args.square_size)
+elif args.cloud is not None:
+    parser.error(f"{args.calibrationFile} has no disparity_to_depth_matrix, so there is no depth")
+cloudWriter = CloudWriter(args.cloud, args.cloud_format) if args.cloud is not None else None
+
+interpolationTiers = list(INTERPOLATION_TIERS)
+rectifier = Rectifier(leftStereoMap, rightStereoMap, "linear")
 
 # Setting parameters for StereoSGBM algorithm
 minDisparity = 0;
@@ -53,7 +121,8 @@ speckleWindowSize = 10;
 speckleRange = 8;
 
 # Creating an object of StereoSGBM algorithm
-stereo = cv2.StereoSGBM_create(minDisparity = minDisparity,
+def createMatcher():
+    return cv2.StereoSGBM_create(minDisparity = minDisparity,
         numDisparities = numDisparities,
         blockSize = blockSize,
         disp12MaxDiff = disp12MaxDiff,
@@ -62,109 +131,129 @@ stereo = cv2.StereoSGBM_create(minDisparity = minDisparity,
         speckleRange = speckleRange
     )
 
-# stereo = cv2.StereoBM_create()
-capLeft = cv2.VideoCapture(sys.argv[2])
-capRight = cv2.VideoCapture(sys.argv[3])
+# createMatcher = cv2.StereoBM_create
+matcherPool = MatcherPool(createMatcher)
+stereoParameters = StereoParameters()
+disparityEngine = StripDisparityEngine(stereoParameters, createMatcher, args.bands)
+# Coarse to fine matching, for wide search ranges
+pyramidEngine = PyramidDisparityEngine(stereoParameters, createMatcher)
+# Reuses the disparity of unchanged tiles
+temporalEngine = TemporalDisparityEngine(stereoParameters, createMatcher) if args.temporal else None
+postFilter = PostFilter(stereoParameters, createMatcher, postFilterSteps)
+# Disparity to color, one per window as each keeps its own output buffer
+rectifiedRenderer = DisparityRenderer()
+unrectifiedRenderer = DisparityRenderer()
+
+# Trackbar position to matcher parameter, where it is not the same
+trackbarConversions = {
+    'numDisparities': lambda v: v * 16,
+    'blockSize': lambda v: v * 2 + 5,
+    'preFilterSize': lambda v: v * 2 + 5,
+    'speckleWindowSize': lambda v: v * 2,
+}
+
+def onTrackbar(name):
+    convert = trackbarConversions.get(name, lambda v: v)
+    return lambda value: stereoParameters.set(name, convert(value))
+
+# Both cameras grabbed together and paired by timestamp
+cap = StereoCapture(args.leftDevice, args.rightDevice)
 
 rectifiedDispWindowName = "Rectified Disparity map"
 
 cv2.namedWindow(rectifiedDispWindowName)
 cv2.resizeWindow(rectifiedDispWindowName, 600, 600)
 
-cv2.createTrackbar('numDisparities', rectifiedDispWindowName,1,17,nothing)
-cv2.createTrackbar('blockSize', rectifiedDispWindowName,5,50,nothing)
-cv2.createTrackbar('preFilterType', rectifiedDispWindowName,1,1,nothing)
-cv2.createTrackbar('preFilterSize',rectifiedDispWindowName,2,25,nothing)
-cv2.createTrackbar('preFilterCap',rectifiedDispWindowName,5,62,nothing)
-cv2.createTrackbar('textureThreshold',rectifiedDispWindowName,10,100,nothing)
-cv2.createTrackbar('uniquenessRatio',rectifiedDispWindowName,15,100,nothing)
-cv2.createTrackbar('speckleRange',rectifiedDispWindowName,0,100,nothing)
-cv2.createTrackbar('speckleWindowSize',rectifiedDispWindowName,3,25,nothing)
-cv2.createTrackbar('disp12MaxDiff',rectifiedDispWindowName,5,25,nothing)
-cv2.createTrackbar('minDisparity',rectifiedDispWindowName,5,25,nothing)
+cv2.createTrackbar('numDisparities', rectifiedDispWindowName,1,17,onTrackbar('numDisparities'))
+cv2.createTrackbar('blockSize', rectifiedDispWindowName,5,50,onTrackbar('blockSize'))
+cv2.createTrackbar('preFilterType', rectifiedDispWindowName,1,1,onTrackbar('preFilterType'))
+cv2.createTrackbar('preFilterSize',rectifiedDispWindowName,2,25,onTrackbar('preFilterSize'))
+cv2.createTrackbar('preFilterCap',rectifiedDispWindowName,5,62,onTrackbar('preFilterCap'))
+cv2.createTrackbar('textureThreshold',rectifiedDispWindowName,10,100,onTrackbar('textureThreshold'))
+cv2.createTrackbar('uniquenessRatio',rectifiedDispWindowName,15,100,onTrackbar('uniquenessRatio'))
+cv2.createTrackbar('speckleRange',rectifiedDispWindowName,0,100,onTrackbar('speckleRange'))
+cv2.createTrackbar('speckleWindowSize',rectifiedDispWindowName,3,25,onTrackbar('speckleWindowSize'))
+cv2.createTrackbar('disp12MaxDiff',rectifiedDispWindowName,5,25,onTrackbar('disp12MaxDiff'))
+cv2.createTrackbar('minDisparity',rectifiedDispWindowName,5,25,onTrackbar('minDisparity'))
+
+# Start from the initial trackbar positions
+for name in ['numDisparities', 'blockSize', 'preFilterType', 'preFilterSize', 'preFilterCap', 'textureThreshold',
+             'uniquenessRatio', 'speckleRange', 'speckleWindowSize', 'disp12MaxDiff', 'minDisparity']:
+    onTrackbar(name)(cv2.getTrackbarPos(name, rectifiedDispWindowName))
+cv2.createTrackbar('interpolation',rectifiedDispWindowName,interpolationTiers.index("linear"),len(interpolationTiers) - 1,nothing)
+# 0 is plain matching, 1 and 2 match at 1/2 and 1/4 resolution first
+cv2.createTrackbar('pyramid',rectifiedDispWindowName,0,max(MATCHING_MODES.values()),nothing)
 cv2.setMouseCallback(rectifiedDispWindowName, mouseCallback)
 
 
-while capLeft.isOpened() and capRight.isOpened():
-    _, leftImage = capLeft.read()
-    _, rightImage = capRight.read()
+while cap.isOpened():
+    _, leftImage, rightImage = cap.read()
 
     if leftImage is None or rightImage is None:
         print("Could not read one of the pictures\n")
         sys.exit(2)
 
-    cv2.imshow("Left image before rectification", leftImage)
-    cv2.imshow("Right image before rectification", rightImage)
-
-    leftRectified = cv2.remap(leftImage, Left_Stereo_Map_x, Left_Stereo_Map_y, cv2.INTER_LANCZOS4, cv2.BORDER_CONSTANT, 0)
-    rightRectified = cv2.remap(rightImage, Right_Stereo_Map_x, Right_Stereo_Map_y, cv2.INTER_LANCZOS4, cv2.BORDER_CONSTANT, 0)
-
-    cv2.imshow("Left image after rectification", leftRectified)
-    cv2.imshow("Right image after rectification", rightRectified)
-
-    # Updating the parameters based on the trackbar positions
-    numDisparities = cv2.getTrackbarPos('numDisparities', rectifiedDispWindowName) * 16
-    blockSize = cv2.getTrackbarPos('blockSize', rectifiedDispWindowName) * 2 + 5
-    preFilterType = cv2.getTrackbarPos('preFilterType', rectifiedDispWindowName)
-    preFilterSize = cv2.getTrackbarPos('preFilterSize', rectifiedDispWindowName) * 2 + 5
-    preFilterCap = cv2.getTrackbarPos('preFilterCap', rectifiedDispWindowName)
-    textureThreshold = cv2.getTrackbarPos('textureThreshold', rectifiedDispWindowName)
-    uniquenessRatio = cv2.getTrackbarPos('uniquenessRatio', rectifiedDispWindowName)
-    speckleRange = cv2.getTrackbarPos('speckleRange', rectifiedDispWindowName)
-    speckleWindowSize = cv2.getTrackbarPos('speckleWindowSize', rectifiedDispWindowName) * 2
-    disp12MaxDiff = cv2.getTrackbarPos('disp12MaxDiff', rectifiedDispWindowName)
-    minDisparity = cv2.getTrackbarPos('minDisparity', rectifiedDispWindowName)
-
-    # Setting the updated parameters before computing disparity map
-    stereo.setNumDisparities(numDisparities)
-    stereo.setBlockSize(blockSize)
-    # stereo.setPreFilterType(preFilterType)
-    # stereo.setPreFilterSize(preFilterSize)
-    stereo.setPreFilterCap(preFilterCap)
-    # stereo.setTextureThreshold(textureThreshold)
-    stereo.setUniquenessRatio(uniquenessRatio)
-    stereo.setSpeckleRange(speckleRange)
-    stereo.setSpeckleWindowSize(speckleWindowSize)
-    stereo.setDisp12MaxDiff(disp12MaxDiff)
-    stereo.setMinDisparity(minDisparity)
-
-    # out = rightRectified.copy()
-    # out[:,:,0] = rightRectified[:,:,0]
-    # out[:,:,1] = rightRectified[:,:,1]
-    # out[:,:,2] = leftRectified[:,:,2]
-
-    out = leftRectified.copy()
-    out[:,:,0] = leftRectified[:,:,0]
-    out[:,:,1] = leftRectified[:,:,1]
-    out[:,:,2] = rightRectified[:,:,2]
-
-    cv2.imshow("Rectified Output image", out)
-
-    grayLeftRectified = cv2.cvtColor(leftRectified, cv2.COLOR_BGR2GRAY)
-    grayRightRectified = cv2.cvtColor(rightRectified, cv2.COLOR_BGR2GRAY)
-
-    disp = stereo.compute(grayLeftRectified, grayRightRectified).astype(np.float32)
-    dispNormalilzed = cv2.normalize(disp, 0, 255, cv2.NORM_MINMAX)
-    cv2.imshow(rectifiedDispWindowName, dispNormalilzed)
-
-    out = leftImage.copy()
-    out[:,:,0] = leftImage[:,:,0]
-    out[:,:,1] = leftImage[:,:,1]
-    out[:,:,2] = rightImage[:,:,2]
-    cv2.imshow("Unrectified Output image", out)
-
-    grayLeft = cv2.cvtColor(leftImage, cv2.COLOR_BGR2GRAY)
-    grayRight = cv2.cvtColor(rightImage, cv2.COLOR_BGR2GRAY)
-
-    dispUnrectified = stereo.compute(grayLeft, grayRight).astype(np.float32)
-    dispUnrectified = cv2.normalize(disp, 0, 255, cv2.NORM_MINMAX)
-    cv2.imshow("Unrectified Disparity map", dispUnrectified)
+    if "raw" in views:
+        cv2.imshow("Left image before rectification", leftImage)
+        cv2.imshow("Right image before rectification", rightImage)
+
+    if "unrectified-anaglyph" in views:
+        cv2.imshow("Unrectified Output image", anaglyph(leftImage, rightImage))
+
+    # Only rectify (and only in color) when something needs it
+    if needColor or needRectifiedGray:
+        rectifier.setTier(interpolationTiers[cv2.getTrackbarPos('interpolation', rectifiedDispWindowName)])
+        grayLeftRectified, grayRightRectified, leftRectified, rightRectified = rectifier.rectify(
+                                            leftImage, rightImage, color=needColor)
+
+    if "rectified" in views:
+        cv2.imshow("Left image after rectification", leftRectified)
+        cv2.imshow("Right image after rectification", rightRectified)
+
+    if "anaglyph" in views:
+        cv2.imshow("Rectified Output image", anaglyph(leftRectified, rightRectified))
+
+    # The trackbars update the parameters, the matchers are only reconfigured when they change
+    if needRectifiedGray:
+        pyramidEngine.setLevels(cv2.getTrackbarPos('pyramid', rectifiedDispWindowName))
+        engine = pyramidEngine if pyramidEngine.levels else disparityEngine
+        if temporalEngine is not None:
+            fixedPointDisparity = temporalEngine.compute(grayLeftRectified, grayRightRectified, engine)
+        else:
+            fixedPointDisparity = engine.compute(grayLeftRectified, grayRightRectified)
+        fixedPointDisparity = postFilter.apply(fixedPointDisparity, grayLeftRectified, grayRightRectified)
+        disp = fixedPointDisparity
+
+    if "disparity" in views:
+        cv2.imshow(rectifiedDispWindowName, rectifiedRenderer.render(disp, *postFilter.range()))
+
+    if cloudWriter is not None:
+        cloudWriter.write(*depthStage.pointCloud(fixedPointDisparity, leftRectified, args.voxel))
+
+    if "unrectified-disparity" in views:
+        grayLeft = cv2.cvtColor(leftImage, cv2.COLOR_BGR2GRAY)
+        grayRight = cv2.cvtColor(rightImage, cv2.COLOR_BGR2GRAY)
+
+        matcher = matcherPool.get(stereoParameters)
+        dispUnrectified = matcher.compute(grayLeft, grayRight)
+        cv2.imshow("Unrectified Disparity map", unrectifiedRenderer.render(
+                    dispUnrectified, matcher.getMinDisparity(), matcher.getNumDisparities()))
 
     key = cv2.waitKey(20)
 
     if key == 27:
         break
-
-capLeft.release()
-capRight.release()
+    elif key == ord('b'):
+        print("Rectification benchmark")
+        print(formatBenchmark(rectifier.benchmark(leftImage, rightImage)))
+    elif key == ord('c') and needRectifiedGray:
+        print("Matching modes against plain matching")
+        print(formatComparison(pyramidEngine.compare(grayLeftRectified, grayRightRectified)))
+
+print("Stereo capture", cap.report())
+if temporalEngine is not None:
+    print("Disparity", temporalEngine.report())
+if postFilterSteps:
+    print("Post-filter", postFilter.report())
+cap.release()
 cv2.destroyAllWindows()
\ No newline at end of file
@@ -19,6 +19,17 @@ import sys
 import wx, wx.grid
 from PIL import Image
 
+from capture import RingCapture, StereoCapture
+from chessboard import CORNER_CACHE_FILE, ChessboardTracker, CornerCache, CoverageIndex
+from coefficients import BUNDLE_EXTENSION, StereoCalibration, isBundle, loadXmlMaps
+from colormap import DisparityRenderer
+from depth import CloudWriter, DepthStage
+from postfilter import POSTFILTER_STEPS, PostFilter
+from disparity import (MATCHING_MODES, PyramidDisparityEngine, StereoParameters, StripDisparityEngine,
+                       TemporalDisparityEngine, formatComparison)
+from rectification import INTERPOLATION_TIERS, Rectifier, formatBenchmark
+from solver import CalibrationSolver, IncrementalCalibrator, solveStereo
+
 scriptPath = os.path.dirname(os.path.abspath(__file__))
 logger = logging.getLogger('stereo_wx')
 
@@ -88,7 +99,7 @@ class WxStereo(wx.Frame):
         self.objpoints = []
 
         # Creating vector to store vectors of 2D points for each checkerboard image
-        self.imgpointsleft = []
+        self.imgpointsLeft = []
         self.imgpointsRight = []
 
         # Defining the world coordinates for 3D points
@@ -211,69 +222,166 @@ class WxStereo(wx.Frame):
         self.takeCalibrationPicture = True
         logger.debug("Take calibration pic")
 
+    def onAutoCapture(self, evt):
+        # The index is made on the video thread, which knows the frame size
+        self.coverageIndex = None
+        self.autoCapture = self.autoCaptureItem.IsChecked()
+
+    def autoCapturePicture(self, corners, imageSize):
+        """Whether to take the board as a calibration picture, on the video thread."""
+        # Read once, the menu can reset it meanwhile
+        coverageIndex = self.coverageIndex
+        if coverageIndex is None or coverageIndex.imageSize != imageSize or \
+                coverageIndex.checkerboard != self.CHECKERBOARD:
+            coverageIndex = self.coverageIndex = CoverageIndex(imageSize, self.CHECKERBOARD)
+        if not coverageIndex.offer(corners):
+            return False
+
+        logger.info(f"Auto capture, {coverageIndex.report()}")
+        if coverageIndex.complete():
+            self.autoCapture = False
+            wx.CallAfter(self.autoCaptureItem.Check, False)
+            logger.info("Auto capture done, the pictures cover the target")
+        return True
+
     def onCalibrationCalc(self, evt):
         logger.debug("Calc calibration")
         self.calibrationCalc()
 
+    def onInterpolationChoice(self, evt):
+        if self.rectifier is not None:
+            self.rectifier.setTier(self.interpolationChoice.GetStringSelection())
+
+    def onStereoSlider(self, evt):
+        slider = evt.GetEventObject()
+        name, convert = self.sliderParameters[slider]
+        self.stereoParameters.set(name, convert(slider.GetValue()))
+
+    def onBenchmarkRectification(self, evt):
+        # Run on the video thread, on the frames it is working with
+        self.benchmarkRectification = True
+
+    def onMatchingChoice(self, evt):
+        self.pyramidEngine.setLevels(MATCHING_MODES[self.matchingChoice.GetStringSelection()])
+
+    def onPostFilterCheckBox(self, evt):
+        for step, checkBox in self.postFilterCheckBoxes.items():
+            self.postFilter.enable(step, checkBox.GetValue())
+
+    def onCompareMatching(self, evt):
+        # Run on the video thread, on the frames it is working with
+        self.compareMatching = True
+
+    def showComparison(self, results):
+        report = formatComparison(results)
+        logger.info(f"Matching modes against plain matching\n{report}")
+        dlg = wx.MessageDialog(self, report, "Matching comparison")
+        dlg.ShowModal()
+        dlg.Destroy()
+
+    def showBenchmark(self, results):
+        report = formatBenchmark(results)
+        logger.info(f"Rectification benchmark\n{report}")
+        dlg = wx.MessageDialog(self, report, "Rectification benchmark")
+        dlg.ShowModal()
+        dlg.Destroy()
+
+    def getRectifier(self):
+        # Maps are replaced on calibration or load, which drops the rectifier
+        if self.rectifier is None:
+            self.rectifier = Rectifier(self.leftStereoMap, self.rightStereoMap,
+                                       self.interpolationChoice.GetStringSelection())
+        return self.rectifier
+
     #---------------------------------------------------------------------
 
     def saveCoefficients(self, evt):
-        if self.leftStereoMap is None or self.rightStereoMap is None:
-            wx.MessageDialog(self, "No calibration coefficients available")
+        if self.stereoCalibration is None:
+            wx.MessageBox("Calibrate first, there are no calibration coefficients to save", "No calibration")
             return
 
-        with wx.FileDialog(self, "Open coefficients file", defaultDir=os.path.expanduser("~/Videos"), wildcard="XML files|*xml",
-                           style=wx.FD_SAVE) as fileDialog:
+        with wx.FileDialog(self, "Save coefficients file", defaultDir=os.path.expanduser("~/Videos"),
+                           wildcard=f"Calibration files|*{BUNDLE_EXTENSION}",
+                           style=wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT) as fileDialog:
             if fileDialog.ShowModal() == wx.ID_CANCEL:
                 return
 
-            file = cv2.FileStorage(fileDialog.GetPath(), cv2.FILE_STORAGE_WRITE)
-
-            file.write("left_camera_matrix", self.newCameraMatrixLeft)
-            file.write("left_distortion_coefficients",  self.distCoeffsLeft)
-            file.write("left_stereo_rectification", self.leftRectification)
-            file.write("left_stereo_projection", self.projectionMatrixLeft)
-
-            file.write("right_camera_matrix", self.newCameraMatrixRight)
-            file.write("right_distortion_coefficients",  self.distCoeffsRight)
-            file.write("right_stereo_rectification", self.rightRectification)
-            file.write("right_stereo_projection", self.projectionMatrixRight)
-
-            file.write("Left_Stereo_Map_x", self.leftStereoMap[0])
-            file.write("Left_Stereo_Map_y", self.leftStereoMap[1])
-            file.write("Right_Stereo_Map_x", self.rightStereoMap[0])
-            file.write("Right_Stereo_Map_y", self.rightStereoMap[1])
-            file.release()
+            # Only the matrices, the maps are made again on load
+            path = fileDialog.GetPath()
+            if not path.endswith(BUNDLE_EXTENSION):
+                path += BUNDLE_EXTENSION
+            self.stereoCalibration.save(path)
 
     #---------------------------------------------------------------------
 
     def loadCoefficients(self, evt):
-        with wx.FileDialog(self, "Open coefficients file", defaultDir=os.path.expanduser("~/Videos"), wildcard="XML files|*xml",
+        with wx.FileDialog(self, "Open coefficients file", defaultDir=os.path.expanduser("~/Videos"),
+                           wildcard=f"Calibration files|*{BUNDLE_EXTENSION}|XML files|*xml",
                            style=wx.FD_OPEN | wx.FD_FILE_MUST_EXIST) as fileDialog:
             if fileDialog.ShowModal() == wx.ID_CANCEL:
                 return
 
-            file = cv2.FileStorage(fileDialog.GetPath(), cv2.FILE_STORAGE_READ)
-            file.getNode("")
+            path = fileDialog.GetPath()
+            if isBundle(path):
+                try:
+                    calibration = StereoCalibration.load(path)
+                except (OSError, ValueError) as exception:
+                    wx.MessageBox(str(exception), "Cannot load calibration")
+                    return
+                self.loadCalibration(calibration)
+                return
 
-            self.newCameraMatrixLeft = file.getNode("left_camera_matrix").mat()
-            self.distCoeffsLeft = file.getNode("left_distortion_coefficients").mat()
-            self.leftRectification = file.getNode("left_stereo_rectification").mat()
-            self.projectionMatrixLeft = file.getNode("left_stereo_projection").mat()
+            # Older XML files with the full maps, Q None in files saved before it was stored
+            self.leftStereoMap, self.rightStereoMap, self.Qmatrix = loadXmlMaps(path)
+            # Only the maps and Q are used, the matrices of an earlier calibration no longer apply.
+            # No rotation and translation in the file, so it cannot be saved again
+            self.newCameraMatrixLeft = self.distCoeffsLeft = self.leftRectification = None
+            self.newCameraMatrixRight = self.distCoeffsRight = self.rightRectification = None
+            self.projectionMatrixLeft = self.projectionMatrixRight = self.rotation = self.translation = None
+            self.stereoCalibration = None
+            self.rectifier = None
+            self.depthStage = None
+
+    def loadCalibration(self, calibration):
+        # Maps memory-mapped from the cache next to the file, or made and cached there
+        leftStereoMap, rightStereoMap = calibration.maps()
+        rectifier = Rectifier(leftStereoMap, rightStereoMap, self.interpolationChoice.GetStringSelection())
+
+        self.newCameraMatrixLeft, self.distCoeffsLeft = calibration.cameraMatrixLeft, calibration.distCoeffsLeft
+        self.leftRectification, self.projectionMatrixLeft = calibration.rectificationLeft, calibration.projectionLeft
+        self.newCameraMatrixRight, self.distCoeffsRight = calibration.cameraMatrixRight, calibration.distCoeffsRight
+        self.rightRectification, self.projectionMatrixRight = calibration.rectificationRight, calibration.projectionRight
+        self.rotation, self.translation = calibration.rotation, calibration.translation
+        self.Qmatrix = calibration.Q
+        self.leftStereoMap, self.rightStereoMap = leftStereoMap, rightStereoMap
+        self.stereoCalibration = calibration
+        self.depthStage = None
+        # Last, like after a calibration
+        self.rectifier = rectifier
+
+    def recordPointClouds(self, evt):
+        if self.cloudWriter is not None:
+            self.cloudWriter = None
+            logger.info("Stopped recording point clouds")
+            return
 
-            self.newCameraMatrixRight = file.getNode("right_camera_matrix").mat()
-            self.distCoeffsRight = file.getNode("right_distortion_coefficients").mat()
-            self.rightRectification = file.getNode("right_stereo_rectification").mat()
-            self.projectionMatrixRight = file.getNode("right_stereo_projection").mat()
+        if self.Qmatrix is None:
+            wx.MessageBox("Calibrate or load a calibration with a disparity to depth matrix first", "No depth")
+            return
 
-            self.leftStereoMap = []
-            self.rightStereoMap = []
+        with wx.DirDialog(self, "Point cloud folder", defaultPath=os.path.expanduser("~/Videos")) as dirDialog:
+            if dirDialog.ShowModal() == wx.ID_CANCEL:
+                return
+            self.cloudWriter = CloudWriter(dirDialog.GetPath())
+            logger.info(f"Recording point clouds to {dirDialog.GetPath()}")
 
-            self.leftStereoMap.append(file.getNode("Left_Stereo_Map_x").mat())
-            self.leftStereoMap.append(file.getNode("Left_Stereo_Map_y").mat())
-            self.rightStereoMap.append(file.getNode("Right_Stereo_Map_x").mat())
-            self.rightStereoMap.append(file.getNode("Right_Stereo_Map_y").mat())
-            file.release()
+    def getDepthStage(self):
+        # Depth is in chessboard squares, like the calibration. Read once, a new
+        # calibration can reset it meanwhile
+        depthStage, Qmatrix = self.depthStage, self.Qmatrix
+        if depthStage is None and Qmatrix is not None:
+            depthStage = self.depthStage = DepthStage(Qmatrix)
+        return depthStage
 
     # ------------------------------------------------------------------------------------------
 
@@ -287,19 +395,41 @@ class WxStereo(wx.Frame):
         self.rightDevice = None
         self.capLeft = None
         self.capRight = None
+        self.stereoCapture = None
         self.rightWxImageForDisplay = None
         self.leftWxImageForDisplay = None
         self.rightWxOutputForDisplay = None
         self.leftWxOutputForDisplay = None
         self.takeCalibrationPicture = False
+        # Takes pictures of board poses not covered yet
+        self.autoCapture = False
+        self.coverageIndex = None
         self.readSavedPictures = False
         self.imageSavepath = tempfile.mkdtemp()
         self.savedImageNumber = 0
         self.objpoints = []
         self.imgpointsLeft = []
         self.imgpointsRight = []
-        self.stereo = cv2.StereoBM_create()
-
+        self.imageSize = None
+        self.rectifier = None
+        self.benchmarkRectification = False
+        self.compareMatching = False
+        self.Qmatrix = None
+        # What saveCoefficients writes, from a calibration or a loaded file
+        self.stereoCalibration = None
+        self.depthStage = None
+        self.cloudWriter = None
+        # Solves in a worker process, the dialog shows its progress
+        self.calibrationSolver = CalibrationSolver()
+        self.calibrationDialog = None
+        # Solved again in the background as pictures are added
+        self.calibrator = None
+        # From starting a solve until its result or failure is handled here. The worker
+        # process ends before that, and self.calibrator is not solved until then
+        self.calibrationBusy = False
+        self.calibrationPending = False
+        self.calibrationTimer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.onCalibrationTimer, self.calibrationTimer)
 
         self.setupChessboard(6, 9)
         menubar = wx.MenuBar()
@@ -333,6 +463,19 @@ class WxStereo(wx.Frame):
         loadCoefficientsItem = fileMenu.Append(wx.ID_ANY, 'Load calibration...')
         self.Bind(wx.EVT_MENU, self.loadCoefficients, loadCoefficientsItem)
 
+        benchmarkItem = fileMenu.Append(wx.ID_ANY, 'Benchmark rectification')
+        self.Bind(wx.EVT_MENU, self.onBenchmarkRectification, benchmarkItem)
+
+        compareMatchingItem = fileMenu.Append(wx.ID_ANY, 'Compare matching modes')
+        self.Bind(wx.EVT_MENU, self.onCompareMatching, compareMatchingItem)
+
+        recordPointCloudsItem = fileMenu.Append(wx.ID_ANY, 'Record point clouds...', 'Start or stop writing a point cloud per frame')
+        self.Bind(wx.EVT_MENU, self.recordPointClouds, recordPointCloudsItem)
+
+        self.autoCaptureItem = fileMenu.AppendCheckItem(wx.ID_ANY, 'Auto capture calibration pics',
+                                                        'Take pictures of new board poses until they cover enough')
+        self.Bind(wx.EVT_MENU, self.onAutoCapture, self.autoCaptureItem)
+
         fileItem = fileMenu.Append(wx.ID_EXIT, 'Quit', 'Quit application')
         self.Bind(wx.EVT_MENU, self.Close, fileItem)
         menubar.Append(fileMenu, '&File')
@@ -380,6 +523,16 @@ class WxStereo(wx.Frame):
         self.slider_speckleWindowSize = wx.Slider(adjustmentsPanel, value = 3,  maxValue = 25)
         self.slider_disp12MaxDiff =     wx.Slider(adjustmentsPanel, value = 5,  maxValue = 25)
         self.slider_minDisparity =      wx.Slider(adjustmentsPanel, value = 5,  maxValue = 25)
+        self.interpolationChoice =      wx.Choice(adjustmentsPanel, choices = list(INTERPOLATION_TIERS))
+        self.interpolationChoice.SetStringSelection("linear")
+        self.interpolationChoice.Bind(wx.EVT_CHOICE, self.onInterpolationChoice)
+        self.matchingChoice =           wx.Choice(adjustmentsPanel, choices = list(MATCHING_MODES))
+        self.matchingChoice.SetStringSelection("plain")
+        self.matchingChoice.Bind(wx.EVT_CHOICE, self.onMatchingChoice)
+        self.temporalCheckBox =         wx.CheckBox(adjustmentsPanel)
+        self.postFilterCheckBoxes = {step: wx.CheckBox(adjustmentsPanel) for step in POSTFILTER_STEPS}
+        for checkBox in self.postFilterCheckBoxes.values():
+            checkBox.Bind(wx.EVT_CHECKBOX, self.onPostFilterCheckBox)
 
         adjustmentsSizer.Add(wx.StaticText(adjustmentsPanel,label = 'numDisparities'));
         adjustmentsSizer.Add(self.slider_numDisparities)
@@ -403,9 +556,48 @@ class WxStereo(wx.Frame):
         adjustmentsSizer.Add(self.slider_disp12MaxDiff)
         adjustmentsSizer.Add(wx.StaticText(adjustmentsPanel,label = 'minDisparity'));
         adjustmentsSizer.Add(self.slider_minDisparity)
+        adjustmentsSizer.Add(wx.StaticText(adjustmentsPanel,label = 'interpolation'));
+        adjustmentsSizer.Add(self.interpolationChoice)
+        adjustmentsSizer.Add(wx.StaticText(adjustmentsPanel,label = 'matching'));
+        adjustmentsSizer.Add(self.matchingChoice)
+        adjustmentsSizer.Add(wx.StaticText(adjustmentsPanel,label = 'reuse static tiles'));
+        adjustmentsSizer.Add(self.temporalCheckBox)
+        for step, checkBox in self.postFilterCheckBoxes.items():
+            adjustmentsSizer.Add(wx.StaticText(adjustmentsPanel,label = step));
+            adjustmentsSizer.Add(checkBox)
 
         adjustmentsPanel.SetSizer(adjustmentsSizer)
 
+        # Slider value to matcher parameter. The matcher is only reconfigured
+        # when one of these actually changes.
+        self.sliderParameters = {
+            self.slider_numDisparities:    ("numDisparities",    lambda v: v * 16),
+            self.slider_blockSize:         ("blockSize",         lambda v: v * 2 + 5),
+            self.slider_preFilterType:     ("preFilterType",     lambda v: v),
+            self.slider_preFilterSize:     ("preFilterSize",     lambda v: v * 2 + 5),
+            self.slider_preFilterCap:      ("preFilterCap",      lambda v: v),
+            self.slider_textureThreshold:  ("textureThreshold",  lambda v: v),
+            self.slider_uniquenessRatio:   ("uniquenessRatio",   lambda v: v),
+            self.slider_speckleRange:      ("speckleRange",      lambda v: v),
+            self.slider_speckleWindowSize: ("speckleWindowSize", lambda v: v * 2),
+            self.slider_disp12MaxDiff:     ("disp12MaxDiff",     lambda v: v),
+            self.slider_minDisparity:      ("minDisparity",      lambda v: v),
+        }
+        self.stereoParameters = StereoParameters(**{name: convert(slider.GetValue())
+                                                    for slider, (name, convert) in self.sliderParameters.items()})
+        # Matched in horizontal bands, one per core
+        self.disparityEngine = StripDisparityEngine(self.stereoParameters, cv2.StereoBM_create)
+        # Coarse to fine matching, for wide search ranges
+        self.pyramidEngine = PyramidDisparityEngine(self.stereoParameters, cv2.StereoBM_create, levels=0)
+        # Reuses the disparity of unchanged tiles when the scene is still
+        self.temporalEngine = TemporalDisparityEngine(self.stereoParameters, cv2.StereoBM_create)
+        # Optional clean up of the matcher output, and the conversion for display
+        self.postFilter = PostFilter(self.stereoParameters, cv2.StereoBM_create)
+        self.disparityRenderer = DisparityRenderer(rgb=True)
+        self.disparityFrames = 0
+        for slider in self.sliderParameters:
+            slider.Bind(wx.EVT_SLIDER, self.onStereoSlider)
+
         self.SetSize(0, 0, 1280 * 3 // 2, 960)
         self.Center()
         self.Show()
@@ -443,7 +635,7 @@ class WxStereo(wx.Frame):
         if inputMat is None or not inputMat.size:
             return
         logger.debug("Display left image")
-        imageForDisplay = cv2.cvtColor(inputMat.copy(), cv2.COLOR_BGR2RGB)
+        imageForDisplay = cv2.cvtColor(inputMat, cv2.COLOR_BGR2RGB)
         self.leftWxImageForDisplay = self.resizeWithAspectRatio(imageForDisplay, self.leftInputPanel)
         self.leftInputPanel.Refresh()
 
@@ -452,15 +644,16 @@ class WxStereo(wx.Frame):
         if inputMat is None or not inputMat.size:
             return
         logger.debug("Display right image")
-        imageForDisplay = cv2.cvtColor(inputMat.copy(), cv2.COLOR_BGR2RGB)
+        imageForDisplay = cv2.cvtColor(inputMat, cv2.COLOR_BGR2RGB)
         self.rightWxImageForDisplay = self.resizeWithAspectRatio(imageForDisplay, self.rightInputPanel)
         self.rightInputPanel.Refresh()
 
-    def displayLeftOutputImage(self, inputMat):
+    def displayLeftOutputImage(self, inputMat, rgb=False):
         if inputMat is None or not inputMat.size:
             return
         logger.debug("Display left image")
-        imageForDisplay = cv2.cvtColor(inputMat.copy(), cv2.COLOR_BGR2RGB)
+        # The resize makes the copy, so a reused buffer can be passed in
+        imageForDisplay = inputMat if rgb else cv2.cvtColor(inputMat, cv2.COLOR_BGR2RGB)
         self.leftWxOutputForDisplay = self.resizeWithAspectRatio(imageForDisplay, self.leftOutputPanel)
         self.leftOutputPanel.Refresh()
 
@@ -469,7 +662,7 @@ class WxStereo(wx.Frame):
         if inputMat is None or not inputMat.size:
             return
         logger.debug("Display right image")
-        imageForDisplay = cv2.cvtColor(inputMat.copy(), cv2.COLOR_BGR2RGB)
+        imageForDisplay = cv2.cvtColor(inputMat, cv2.COLOR_BGR2RGB)
         self.rightWxOutputForDisplay = self.resizeWithAspectRatio(imageForDisplay, self.rightOutputPanel)
         self.rightOutputPanel.Refresh()
 
@@ -481,6 +674,11 @@ class WxStereo(wx.Frame):
         leftImage = None
         rightImage = None
         storedPic = False
+        storedCorners = None
+        cornerCache = None
+        # Live frames search a downscaled frame, near the last board once found
+        leftTracker = ChessboardTracker()
+        rightTracker = ChessboardTracker()
         rightOK = False
         leftOK = False
         self.savedImageNumber = 0
@@ -500,6 +698,9 @@ class WxStereo(wx.Frame):
         self.leftRectification = self.rightRectification = self.projectionMatrixLeft = self.projectionMatrixRight = None
         self.Qmatrix = self.leftROI = self.rightROI = None
         self.leftStereoMap = self.rightStereoMap = None
+        self.stereoCalibration = None
+        self.rectifier = None
+        self.depthStage = None
 
         if self.capLeft is not None:
             self.capLeft.release()
@@ -507,15 +708,22 @@ class WxStereo(wx.Frame):
         if self.capRight is not None:
             self.capRight.release()
 
-        if self.leftDevice is not None:
-            self.capLeft = cv2.VideoCapture(self.leftDevice)
-            self.capLeft.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-            self.capLeft.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
+        if self.stereoCapture is not None:
+            self.stereoCapture.release()
+
+        self.capLeft = self.capRight = self.stereoCapture = None
+
+        if self.leftDevice is not None and self.rightDevice is not None:
+            # Both cameras grabbed together and paired by timestamp. Processing can be
+            # slower than the cameras, so only the newest pair is used.
+            self.stereoCapture = StereoCapture(self.leftDevice, self.rightDevice, width=640, height=480,
+                                               latestOnly=True)
+        else:
+            if self.leftDevice is not None:
+                self.capLeft = RingCapture(self.leftDevice, width=640, height=480)
 
-        if self.rightDevice is not None:
-            self.capRight = cv2.VideoCapture(self.rightDevice)
-            self.capRight.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-            self.capRight.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
+            if self.rightDevice is not None:
+                self.capRight = RingCapture(self.rightDevice, width=640, height=480)
 
         while not self.stopVideo:
             if self.readSavedPictures:
@@ -523,17 +731,29 @@ class WxStereo(wx.Frame):
                 rightImageFile = os.path.join(self.imageSavepath, "rightImage_" + str(self.savedImageNumber) + ".jpg")
 
                 if os.path.exists(leftImageFile) and os.path.exists(rightImageFile):
-                    leftImage = cv2.imread(leftImageFile)
-                    rightImage = cv2.imread(rightImageFile)
+                    # Corners of saved pictures are cached, reloading the same set skips the detection
+                    if cornerCache is None:
+                        cornerCache = CornerCache(os.path.join(self.imageSavepath, CORNER_CACHE_FILE))
+                    leftImage, cornersLeft = cornerCache.load(leftImageFile, self.CHECKERBOARD)
+                    rightImage, cornersRight = cornerCache.load(rightImageFile, self.CHECKERBOARD)
+                    storedCorners = (cornersLeft, cornersRight)
 
                     storedPic = True
                     self.savedImageNumber = self.savedImageNumber + 1
                 else:
                     self.readSavedPictures = False
+                    if cornerCache is not None:
+                        cornerCache.close()
+                        cornerCache = None
                     leftImage = rightImage = None
                     continue
             else:
                 storedPic = False
+                if self.stereoCapture is not None:
+                    pairOK, leftImage, rightImage = self.stereoCapture.read()
+                    if pairOK and self.stereoCapture.pairs % 100 == 0:
+                        logger.debug(f"Stereo capture {self.stereoCapture.report()}")
+
                 if self.capRight is not None:
                     _, rightImage = self.capRight.read()
 
@@ -548,26 +768,22 @@ class WxStereo(wx.Frame):
             self.grayLeft = cv2.cvtColor(leftImage, cv2.COLOR_BGR2GRAY)
             self.grayRight = cv2.cvtColor(rightImage, cv2.COLOR_BGR2GRAY)
 
-            leftRet, cornersLeft = cv2.findChessboardCorners(self.grayLeft, self.CHECKERBOARD,
-                                cv2.CALIB_CB_ADAPTIVE_THRESH + cv2.CALIB_CB_FAST_CHECK + cv2.CALIB_CB_NORMALIZE_IMAGE)
-            rightRet, cornersRight = cv2.findChessboardCorners(self.grayRight, self.CHECKERBOARD,
-                                cv2.CALIB_CB_ADAPTIVE_THRESH + cv2.CALIB_CB_FAST_CHECK + cv2.CALIB_CB_NORMALIZE_IMAGE)
-
-            if leftRet and rightRet:
-                # print("Left corners", cornersLeft)
-                # print("Right corners", cornersRight)
-
-                cornersLeft2 = cv2.cornerSubPix(self.grayLeft, cornersLeft, (11, 11), (-1, -1), self.criteria)
-                cornersRight2 = cv2.cornerSubPix(self.grayRight, cornersRight, (11, 11), (-1, -1), self.criteria)
+            if storedPic:
+                cornersLeft2, cornersRight2 = storedCorners
+            else:
+                # Refined to subpixel at full resolution, None without a chessboard
+                cornersLeft2 = leftTracker.find(self.grayLeft, self.CHECKERBOARD)
+                cornersRight2 = rightTracker.find(self.grayRight, self.CHECKERBOARD)
 
-                displayLeft = cv2.drawChessboardCorners(leftImage.copy(), self.CHECKERBOARD, cornersLeft2, leftRet)
-                displayRight = cv2.drawChessboardCorners(rightImage.copy(), self.CHECKERBOARD, cornersRight2, rightRet)
+            if cornersLeft2 is not None and cornersRight2 is not None:
+                displayLeft = cv2.drawChessboardCorners(leftImage.copy(), self.CHECKERBOARD, cornersLeft2, True)
+                displayRight = cv2.drawChessboardCorners(rightImage.copy(), self.CHECKERBOARD, cornersRight2, True)
 
                 self.displayLeftInputImage(displayLeft)
                 self.displayRightInputImage(displayRight)
 
-                # print("Left corners improved", cornersLeft)
-                # print("Right corners improved", cornersRight)
+                if self.autoCapture and not storedPic and self.autoCapturePicture(cornersLeft2, self.grayLeft.shape[::-1]):
+                    self.takeCalibrationPicture = True
 
                 if (self.takeCalibrationPicture or storedPic) and  len(cornersLeft2) and len(cornersRight2):
                     self.takeCalibrationPicture = False
@@ -577,9 +793,12 @@ class WxStereo(wx.Frame):
                         cv2.imwrite(os.path.join(self.imageSavepath, "rightImage_" + str(self.savedImageNumber) + ".jpg"), rightImage)
                         self.savedImageNumber = self.savedImageNumber + 1;
 
-                    self.imgpointsLeft.append(cornersLeft)
-                    self.imgpointsRight.append(cornersRight)
+                    self.imageSize = self.grayLeft.shape[::-1]
+                    self.imgpointsLeft.append(cornersLeft2)
+                    self.imgpointsRight.append(cornersRight2)
+                    # Last, a calibration snapshot takes as many points as there are objpoints
                     self.objpoints.append(self.objp)
+                    wx.CallAfter(self.onCalibrationPicture)
 
                 else:
                     self.takeCalibrationPicture = False
@@ -592,11 +811,15 @@ class WxStereo(wx.Frame):
             if self.leftStereoMap is not None and len(self.leftStereoMap) and \
                             self.rightStereoMap is not None and len(self.rightStereoMap):
 
-                leftRectifiedImage = cv2.remap(leftImage, self.leftStereoMap[0], self.leftStereoMap[1],
-                                               cv2.INTER_LANCZOS4, cv2.BORDER_CONSTANT, 0)
+                rectifier = self.getRectifier()
 
-                rightRectifiedImage = cv2.remap(rightImage, self.rightStereoMap[0], self.rightStereoMap[1],
-                                               cv2.INTER_LANCZOS4, cv2.BORDER_CONSTANT, 0)
+                if self.benchmarkRectification:
+                    self.benchmarkRectification = False
+                    wx.CallAfter(self.showBenchmark, rectifier.benchmark(leftImage, rightImage))
+
+                # Color is needed for the anaglyph, the gray images come from it
+                grayLeftRectified, grayRightRectified, leftRectifiedImage, rightRectifiedImage = rectifier.rectify(
+                                                leftImage, rightImage, color=True)
 
                 outputAnaglyph = leftRectifiedImage.copy()
                 outputAnaglyph[:, :, 0] = leftRectifiedImage[:, :, 0]
@@ -605,96 +828,123 @@ class WxStereo(wx.Frame):
 
                 self.displayRightOuputImage(outputAnaglyph)
 
-                numDisparities =    self.slider_numDisparities.GetValue()  * 16
-                blockSize =         self.slider_blockSize.GetValue() * 2 + 5
-                preFilterType =     self.slider_preFilterType.GetValue()
-                preFilterSize =     self.slider_preFilterSize.GetValue() * 2 + 5
-                preFilterCap =      self.slider_preFilterCap.GetValue()
-                textureThreshold =  self.slider_textureThreshold.GetValue()
-                uniquenessRatio =   self.slider_uniquenessRatio.GetValue()
-                speckleRange =      self.slider_speckleRange.GetValue()
-                speckleWindowSize = self.slider_speckleWindowSize.GetValue()  * 2
-                disp12MaxDiff =     self.slider_disp12MaxDiff.GetValue()
-                minDisparity =      self.slider_minDisparity.GetValue()
-
-                # Setting the updated parameters before computing disparity map
-                self.stereo.setNumDisparities(numDisparities)
-                self.stereo.setBlockSize(blockSize)
-                self.stereo.setPreFilterType(preFilterType)
-                self.stereo.setPreFilterSize(preFilterSize)
-                self.stereo.setPreFilterCap(preFilterCap)
-                self.stereo.setTextureThreshold(textureThreshold)
-                self.stereo.setUniquenessRatio(uniquenessRatio)
-                self.stereo.setSpeckleRange(speckleRange)
-                self.stereo.setSpeckleWindowSize(speckleWindowSize)
-                self.stereo.setDisp12MaxDiff(disp12MaxDiff)
-                self.stereo.setMinDisparity(minDisparity)
-
-                grayLeftRectified = cv2.cvtColor(leftRectifiedImage, cv2.COLOR_BGR2GRAY)
-                grayRightRectified = cv2.cvtColor(rightRectifiedImage, cv2.COLOR_BGR2GRAY)
-                disparity = self.stereo.compute(grayLeftRectified, grayRightRectified)
-                self.displayLeftOutputImage(disparity.copy().astype(np.uint8))
-
-                # disparity = disparity.astype(np.float32)
-                # disparity = (disparity / 16.0 - minDisparity) / numDisparities
-                # disparity = (disparity * 255).astype(np.uint8)
+                if self.compareMatching:
+                    self.compareMatching = False
+                    wx.CallAfter(self.showComparison, self.pyramidEngine.compare(grayLeftRectified, grayRightRectified))
+
+                # Matchers follow the slider settings, only reconfigured when they change
+                engine = self.pyramidEngine if self.pyramidEngine.levels else self.disparityEngine
+                if self.temporalCheckBox.GetValue():
+                    disparity = self.temporalEngine.compute(grayLeftRectified, grayRightRectified, engine)
+                    if self.temporalEngine.frames % 100 == 0:
+                        logger.debug(f"Disparity {self.temporalEngine.report()}")
+                else:
+                    disparity = engine.compute(grayLeftRectified, grayRightRectified)
+                disparity = self.postFilter.apply(disparity, grayLeftRectified, grayRightRectified)
+
+                # Read once, the menu or a new calibration can reset them meanwhile
+                cloudWriter = self.cloudWriter
+                depthStage = self.getDepthStage() if cloudWriter is not None else None
+                if depthStage is not None:
+                    cloudWriter.write(*depthStage.pointCloud(disparity, leftRectifiedImage))
+                # Colored over the disparity range, straight to RGB
+                self.displayLeftOutputImage(self.disparityRenderer.render(disparity, *self.postFilter.range()), rgb=True)
+
+                self.disparityFrames += 1
+                if self.disparityFrames % 100 == 0:
+                    logger.debug(f"Post-filter {self.postFilter.report()}")
 
 
     #---------------------------------------------------------------------
 
-    def calibrationCalc(self):
-        retvalLeft, self.cameraMatrixLeft, self.distCoeffsLeft, self.rvecsLeft, self.tvecsLeft  = cv2.calibrateCamera(
-                                                                    self.objpoints,
-                                                                    self.imgpointsLeft,
-                                                                    self.grayLeft.shape[::-1],
-                                                                    None, None)
-        hL, wL = self.grayLeft.shape[:2]
-
-        self.newCameraMatrixLeft, self.roiLeft  = cv2.getOptimalNewCameraMatrix(self.cameraMatrixLeft, self.distCoeffsLeft, (wL,hL),1,(wL,hL))
-
-        retvalRight, self.cameraMatrixRight, self.distCoeffsRight, self.rvecsRight, self.tvecsRight = cv2.calibrateCamera(
-                                                                self.objpoints,
-                                                                self.imgpointsRight,
-                                                                self.grayRight.shape[::-1],
-                                                                None,None)
-        hR, wR= self.grayRight.shape[:2]
-        self.newCameraMatrixRight, self.roiRight = cv2.getOptimalNewCameraMatrix(self.cameraMatrixRight, self.distCoeffsRight, (wR,hR),1,(wR,hR))
-
-        flags = 0
-        flags |= cv2.CALIB_FIX_INTRINSIC
-        criteria_stereo = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
-
-        retStereo, self.newCameraMatrixLeft, self.distCoeffsLeft, self.newCameraMatrixRight, self.distCoeffsRight, \
-        self.rotation, self.translation, self.essential, self.fundamental = cv2.stereoCalibrate(
-                            self.objpoints,
-                            self.imgpointsLeft,
-                            self.imgpointsRight,
-                            self.newCameraMatrixLeft,
-                            self.distCoeffsLeft,
-                            self.newCameraMatrixRight,
-                            self.distCoeffsRight,
-                            self.grayLeft.shape[::-1],
-                            criteria_stereo, flags)
-
-        rectify_scale = 1
-        self.leftRectification, self.rightRectification, self.projectionMatrixLeft, self.projectionMatrixRight, \
-        self.Qmatrix, self.leftROI, self.rightROI = cv2.stereoRectify(
-                            self.newCameraMatrixLeft,  self.distCoeffsLeft,  self.newCameraMatrixRight,  self.distCoeffsRight,
-                            self.grayLeft.shape[::-1],
-                            self.rotation, self.translation,
-                            rectify_scale, (0, 0))
-
-        self.leftStereoMap =  cv2.initUndistortRectifyMap(
-                                    self.newCameraMatrixLeft,
-                                    self.distCoeffsLeft,
-                                    self.leftRectification, self.projectionMatrixLeft,
-                                    self.grayLeft.shape[::-1], cv2.CV_16SC2)
-
-        self.rightStereoMap =  cv2.initUndistortRectifyMap(
-                                    self.newCameraMatrixRight,
-                                    self.distCoeffsRight,
-                                    self.rightRectification, self.projectionMatrixRight,
-                                    self.grayRight.shape[::-1], cv2.CV_16SC2)
+    def onCalibrationPicture(self):
+        # Solve again with the new picture, once there are enough of them
+        if self.calibrationBusy:
+            self.calibrationPending = True
+        elif len(self.objpoints) >= IncrementalCalibrator.MIN_VIEWS:
+            self.calibrationCalc(showProgress=False)
+
+    def calibratorMatches(self, count):
+        """Whether self.calibrator holds the first of the count pictures taken, at the same
+        image size. Changing the board clears the pictures, so then it has more views than
+        there are pictures, or its first view is not the first picture any more."""
+        calibrator = self.calibrator
+        if calibrator is None or calibrator.imageSize != self.imageSize or calibrator.viewCount() > count:
+            return False
+        if not calibrator.viewCount():
+            return True
+        # A solved calibrator comes back from the worker as a copy, so compare the points
+        return np.array_equal(calibrator.objpoints[0], self.objpoints[0]) and \
+            np.array_equal(calibrator.imgpoints[0][0], self.imgpointsLeft[0]) and \
+            np.array_equal(calibrator.imgpoints[1][0], self.imgpointsRight[0])
+
+    def calibrationCalc(self, showProgress=True):
+        if self.calibrationBusy:
+            logger.info("Calibration already running")
+            return
+
+        # Snapshot of the points, the video thread keeps adding to the lists
+        count = len(self.objpoints)
+        if not count:
+            logger.info("No images for calibration")
+            return
+        if not self.calibratorMatches(count):
+            self.calibrator = IncrementalCalibrator(self.imageSize, cameras=2)
+        for view in range(self.calibrator.viewCount(), count):
+            self.calibrator.add(self.objpoints[view], self.imgpointsLeft[view], self.imgpointsRight[view])
+        self.calibrationPending = False
+
+        if showProgress:
+            self.calibrationDialog = wx.ProgressDialog("Calibration", f"Calibrating with {count} pictures",
+                                                       maximum=100, parent=self,
+                                                       style=wx.PD_CAN_ABORT | wx.PD_ELAPSED_TIME)
+            self.calibrationTimer.Start(200)
+        self.calibrationSolver.start(solveStereo, (self.calibrator,),
+                                     lambda *progress: wx.CallAfter(self.onCalibrationProgress, *progress),
+                                     lambda result: wx.CallAfter(self.applyCalibration, result),
+                                     lambda message: wx.CallAfter(self.onCalibrationFailed, message))
+        self.calibrationBusy = True
+
+    def onCalibrationProgress(self, step, steps, message):
+        if self.calibrationDialog is not None:
+            self.calibrationDialog.Update(100 * step // steps, message)
+
+    def onCalibrationTimer(self, evt):
+        # The cancel button is only noticed by polling
+        if self.calibrationDialog is not None and self.calibrationDialog.WasCancelled():
+            self.calibrationSolver.cancel()
+
+    def closeCalibrationDialog(self):
+        self.calibrationTimer.Stop()
+        if self.calibrationDialog is not None:
+            self.calibrationDialog.Destroy()
+            self.calibrationDialog = None
+
+    def onCalibrationFailed(self, message):
+        self.calibrationBusy = False
+        self.closeCalibrationDialog()
+        logger.info(f"Calibration failed: {message}")
+        if self.calibrationPending:
+            self.onCalibrationPicture()
+
+    def applyCalibration(self, result):
+        self.calibrationBusy = False
+        self.closeCalibrationDialog()
+        # The result keys are the attribute names. The video thread keeps using the old
+        # rectifier until the new one, made from the new maps, replaces it in one assignment
+        rectifier = Rectifier(result["leftStereoMap"], result["rightStereoMap"],
+                              self.interpolationChoice.GetStringSelection())
+        for name, value in result.items():
+            setattr(self, name, value)
+        self.depthStage = None
+        self.rectifier = rectifier
+        for view in result["droppedViews"]:
+            logger.info(f"Dropped calibration picture {view}, it does not fit the others")
+        logger.info(f"Calibration done, {self.calibrator.report()}")
+        if self.calibrator.converged():
+            logger.info("Calibration converged, more pictures will not improve it")
+        if self.calibrationPending:
+            self.onCalibrationPicture()
 
 # ------------------------------------------------------------------------------------------
 
@@ -11,16 +11,18 @@ import cv2
 import numpy as np
 import sys
 
-#---------------------------------------------------------------------
-def toPanorama(image):
-    image_size = image.shape
-    maxRadius = max(image_size[0] / 2.0, image_size[1] / 2.0)
-
-    output_image = cv2.warpPolar(image, (-1, -1), (image_size[0] / 2.0, image_size[1] / 2.0),
-                                maxRadius, cv2.WARP_POLAR_LINEAR)
+from dewarp import DewarpPlan
+from projections import LinearPolar
 
-    # output_image = cv2.rotate(output_image, cv2.ROTATE_90_CLOCKWISE)
-    return output_image
+#---------------------------------------------------------------------
+def toPanorama(image, projection=None, scale=1.0, azimuthRange=None, radiusRange=None):
+    # The plan is built on the first call and reused for every image of the same size.
+    # scale and the ranges only apply when no projection is given.
+    if projection is None:
+        projection = LinearPolar(scale=scale, azimuthRange=azimuthRange, radiusRange=radiusRange)
+
+    plan = DewarpPlan.forFrame(image, projection=projection)
+    return plan.apply(image)
 
 #---------------------------------------------------------------------
 
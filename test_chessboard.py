@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+###############################################################################
+#
+# Tests of the live chessboard tracker and the coverage index used by auto
+# capture.
+#
+###############################################################################
+import cv2
+import numpy as np
+
+import chessboard
+from chessboard import ChessboardTracker, CoverageIndex, findCorners
+
+CHECKERBOARD = (7, 7)
+IMAGE_SIZE = (640, 480)
+CAMERA_MATRIX = np.array([[600.0, 0.0, 320.0], [0.0, 600.0, 240.0], [0.0, 0.0, 1.0]])
+
+#---------------------------------------------------------------------
+
+def boardCorners(rvec, tvec):
+    objp = np.zeros((CHECKERBOARD[0] * CHECKERBOARD[1], 3), np.float32)
+    objp[:, :2] = np.mgrid[0:CHECKERBOARD[0], 0:CHECKERBOARD[1]].T.reshape(-1, 2)
+    corners, _ = cv2.projectPoints(objp, np.array(rvec, np.float64), np.array(tvec, np.float64), CAMERA_MATRIX, None)
+    return corners.astype(np.float32)
+
+
+def boardImage(imageSize=IMAGE_SIZE, square=30):
+    """A chessboard with CHECKERBOARD inner corners, seen at an angle."""
+    squares = CHECKERBOARD[0] + 1
+    board = np.full(((squares + 2) * square,) * 2, 255, np.uint8)
+    for row in range(squares):
+        for column in range(row % 2, squares, 2):
+            board[(row + 1) * square:(row + 2) * square, (column + 1) * square:(column + 2) * square] = 0
+    size = board.shape[0]
+    transform = cv2.getPerspectiveTransform(np.float32([[0, 0], [size, 0], [size, size], [0, size]]),
+                                            np.float32([[150, 60], [500, 90], [480, 420], [130, 400]]))
+    return cv2.warpPerspective(board, transform, imageSize, borderValue=200)
+
+
+def stillFrames(corners, count, seed=0):
+    rng = np.random.default_rng(seed)
+    return [corners + rng.normal(0, 0.1, corners.shape).astype(np.float32) for _ in range(count)]
+
+
+def test_still_board_is_captured_once():
+    index = CoverageIndex(IMAGE_SIZE, CHECKERBOARD)
+    accepted = [index.offer(frame) for frame in stillFrames(boardCorners((0.1, 0.2, 0.0), (-3, -3, 15)), 8)]
+    assert accepted == [False, True] + [False] * 6
+
+
+def test_board_back_to_front_is_a_duplicate():
+    index = CoverageIndex(IMAGE_SIZE, CHECKERBOARD)
+    corners = boardCorners((0.1, 0.2, 0.0), (-3, -3, 15))
+    assert any(index.offer(frame) for frame in stillFrames(corners, 2))
+    assert not any(index.offer(frame) for frame in stillFrames(corners[::-1], 4, seed=1))
+
+
+def test_new_pose_is_captured():
+    index = CoverageIndex(IMAGE_SIZE, CHECKERBOARD)
+    first = [index.offer(frame) for frame in stillFrames(boardCorners((0.1, 0.2, 0.0), (-3, -3, 15)), 4)]
+    second = [index.offer(frame) for frame in stillFrames(boardCorners((-0.3, 0.1, 0.0), (-6, -5, 12)), 4, seed=1)]
+    assert first.count(True) == 1
+    assert second.count(True) == 1
+    assert index.accepted == 2
+
+
+def test_tracker_searches_live_frames_downscaled(monkeypatch):
+    searched = []
+    findChessboardCorners = cv2.findChessboardCorners
+
+    def recordSearch(image, *args):
+        searched.append(image.shape[::-1])
+        return findChessboardCorners(image, *args)
+
+    monkeypatch.setattr(chessboard.cv2, "findChessboardCorners", recordSearch)
+    gray = boardImage()
+    corners = ChessboardTracker().find(gray, CHECKERBOARD)
+    assert searched == [(320, 240)]
+    # Refined at full resolution, as good as a full size search
+    assert np.abs(corners - findCorners(gray, CHECKERBOARD)).max() < 0.01
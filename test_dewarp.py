@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+###############################################################################
+#
+# Tests of the precomputed dewarp plan against warpPolar + rotate.
+#
+###############################################################################
+import cv2 as cv
+import numpy as np
+import pytest
+
+from dewarp import DewarpPlan
+
+#---------------------------------------------------------------------
+
+@pytest.mark.parametrize("width, height", [(640, 480), (641, 481), (481, 641), (1279, 719)])
+def test_plan_matches_warp_polar(width, height):
+    frame = np.random.default_rng(0).integers(0, 256, (height, width, 3), np.uint8)
+    plan = DewarpPlan.forFrame(frame, cacheDir=None)
+
+    polar = cv.warpPolar(frame, (-1, -1), plan.center, plan.maxRadius, cv.WARP_POLAR_LINEAR)
+    expected = cv.rotate(polar, cv.ROTATE_90_CLOCKWISE)
+    output = plan.apply(frame)
+    assert output.shape == expected.shape
+
+    # Rows inside the image circle, outside it warpPolar leaves its output unset
+    rows = np.arange(output.shape[0]) * plan.maxRadius / output.shape[0] < min(width, height) / 2.0 - 1
+    assert np.array_equal(output[rows], expected[rows])
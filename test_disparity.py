@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+###############################################################################
+#
+# Tests of disparity matched in parallel bands against one plain compute.
+#
+###############################################################################
+import cv2
+import numpy as np
+import pytest
+
+from disparity import StereoParameters, StripDisparityEngine
+
+BLOCK_SIZE = 15
+NUM_DISPARITIES = 32
+
+#---------------------------------------------------------------------
+
+def stereoPair(shape=(480, 640), shift=8):
+    """A textured left image and the right one, the scene shifted by shift pixels."""
+    rng = np.random.default_rng(0)
+    left = cv2.GaussianBlur(rng.integers(0, 255, shape, np.uint8), (3, 3), 0)
+    return left, np.roll(left, -shift, axis=1)
+
+
+@pytest.mark.parametrize("create", [cv2.StereoBM_create, cv2.StereoSGBM_create])
+def test_bands_match_one_compute(create):
+    left, right = stereoPair()
+    parameters = StereoParameters(blockSize=BLOCK_SIZE, numDisparities=NUM_DISPARITIES)
+    threads = cv2.getNumThreads()
+    try:
+        engine = StripDisparityEngine(parameters, create, bands=3)
+        banded = engine.compute(left, right).copy()
+    finally:
+        cv2.setNumThreads(threads)
+
+    matcher = create()
+    matcher.setBlockSize(BLOCK_SIZE)
+    matcher.setNumDisparities(NUM_DISPARITIES)
+    plain = matcher.compute(left, right)
+    # The matchers handle the rows at the image border by the height of their
+    # input, so those are left out
+    rows = slice(BLOCK_SIZE, left.shape[0] - BLOCK_SIZE)
+    assert np.array_equal(banded[rows], plain[rows])
+
+
+def test_bands_must_be_positive():
+    with pytest.raises(ValueError):
+        StripDisparityEngine(StereoParameters(), bands=0)
@@ -6,36 +6,84 @@
 # Script to convert Kodak360P 360 degree video to panoramic
 #
 ###############################################################################
-import cv2 as cv
+import argparse
+import logging
+import math
 import sys
 
+import panorama
+from projections import PROJECTIONS, createProjection
 
-if len(sys.argv) < 3:
-    print("Usage: python to-panorama.py <input file> <output file>\n")
-    print("Too few command line arguments\n")
-    sys.exit(2)
 
-cap = cv.VideoCapture(sys.argv[1])
-outFile = None
+def positiveInt(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
 
-while cap.isOpened():
-    success,input_image = cap.read()
 
-    if input_image is None:
-        break
+def main():
+    parser = argparse.ArgumentParser(description="Convert Kodak360P 360 degree video to panoramic")
+    parser.add_argument("input", help="Input video file, or directory / glob pattern with --batch")
+    parser.add_argument("output", help="Output video file, or output directory with --batch")
+    parser.add_argument("--workers", type=positiveInt, default=1,
+                        help="Number of processes, each converting its own range of frames "
+                             "(or its own files with --batch)")
+    parser.add_argument("--threads", type=positiveInt,
+                        help="Run decode, dewarp and encode as a pipeline with this many dewarp threads "
+                             "(not with --workers or --batch)")
+    parser.add_argument("--batch", action="store_true",
+                        help="Convert every file in a directory or glob, resuming an interrupted batch")
+    parser.add_argument("--manifest", help="Batch manifest file (default: manifest.json in the output directory)")
+    parser.add_argument("--projection", choices=sorted(PROJECTIONS), default="polar", help="Output projection")
+    parser.add_argument("--center", type=float, nargs=2, metavar=("X", "Y"),
+                        help="Lens center in pixels (default: middle of the frame)")
+    parser.add_argument("--radius", type=float,
+                        help="Radius of the image circle in pixels (default: half the larger frame side)")
+    parser.add_argument("--size", type=int, nargs=2, metavar=("WIDTH", "HEIGHT"), help="Output size")
+    parser.add_argument("--fov", type=float, help="Lens field of view in degrees, for equirectangular and cylindrical")
+    parser.add_argument("--scale", type=float, default=1.0, help="Scale of the output, e.g. 0.25 for a quick preview")
+    parser.add_argument("--azimuth", type=float, nargs=2, metavar=("START", "END"),
+                        help="Only convert this sector, in degrees; an END below START wraps through 0")
+    parser.add_argument("--radius-range", type=float, nargs=2, metavar=("INNER", "OUTER"),
+                        help="Only convert this ring, as fractions of the radius")
+    args = parser.parse_args()
 
-    image_size = input_image.shape
-    maxRadius = max(image_size[0] / 2.0, image_size[1] / 2.0)
+    if args.threads is not None and (args.workers > 1 or args.batch):
+        parser.error("--threads cannot be combined with --workers or --batch")
 
-    output_image = cv.warpPolar(input_image, (-1, -1),  (image_size[0] / 2.0, image_size[1] / 2.0),
-                                maxRadius, cv.WARP_POLAR_LINEAR)
+    logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(asctime)s  %(message)s')
 
-    output_image = cv.rotate(output_image, cv.ROTATE_90_CLOCKWISE)
+    if args.scale <= 0:
+        parser.error("--scale must be positive")
 
-    if outFile is None:
-        fps = cap.get(cv.CAP_PROP_FPS)
-        outFile = cv.VideoWriter(sys.argv[2], cv.VideoWriter_fourcc(*'MP4V'), fps, output_image.shape[1::-1])
-    outFile.write(output_image)
+    azimuthRange = tuple(math.radians(a) for a in args.azimuth) if args.azimuth else None
+    try:
+        projection = createProjection(args.projection, center=args.center, radius=args.radius, outputSize=args.size,
+                                      fov=math.radians(args.fov) if args.fov is not None else None,
+                                      scale=args.scale, radiusRange=args.radius_range,
+                                      azimuthRange=azimuthRange)
+    except ValueError as e:
+        parser.error(str(e))
 
-if outFile is not None:
-    outFile.release()
\ No newline at end of file
+    if args.batch:
+        inputs = panorama.collectInputs(args.input)
+        if not inputs:
+            print(f"No input files match {args.input}")
+            return 2
+        try:
+            total, failed = panorama.convertBatch(inputs, args.output, workers=args.workers, manifestFile=args.manifest,
+                                           projection=projection)
+        except ValueError as e:
+            print(e)
+            return 2
+        print(f"Converted {total - failed} of {total} files")
+        return 1 if failed else 0
+
+    frames = panorama.convertFile(args.input, args.output, workers=args.workers, threads=args.threads or 0,
+                                  projection=projection)
+    print(f"Converted {frames} frames")
+
+
+if __name__ == '__main__':
+    sys.exit(main())